@@ -8,6 +8,9 @@ import sys
 import re
 import logging
 import asyncio
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from typing import Dict, Optional, List
 from datetime import datetime
@@ -30,11 +33,17 @@ sys.path.insert(0, str(Path(__file__).parent))
 
 from bots.bot_config_manager import BotConfigManager
 
-# Configure logging
+# Configure logging: records are formatted by the calling thread and enqueued, and a
+# background listener thread writes them out, so bot callbacks never block on log output
+_log_queue = queue.SimpleQueue()
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=logging.INFO,
+    handlers=[QueueHandler(_log_queue)]
 )
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Conversation states
@@ -237,15 +246,16 @@ class AdminBot:
             return
         
         # Get bot statistics
+        # Count active bots from the same snapshot instead of a second config pass
         all_bots = self.config_manager.get_all_bots()
-        active_bots = self.config_manager.get_active_bots()
+        active_count = sum(1 for bot_config in all_bots.values() if bot_config.get('is_active', True))
         
         text = (
             "🤖 *پنل مدیریت ربات‌های VPN*\n\n"
             f"📊 *آمار:*\n"
             f"• کل ربات‌ها: {len(all_bots)}\n"
-            f"• ربات‌های فعال: {len(active_bots)}\n"
-            f"• ربات‌های غیرفعال: {len(all_bots) - len(active_bots)}\n\n"
+            f"• ربات‌های فعال: {active_count}\n"
+            f"• ربات‌های غیرفعال: {len(all_bots) - active_count}\n\n"
             "لطفاً یکی از گزینه‌های زیر را انتخاب کنید:"
         )
         
@@ -1343,12 +1353,13 @@ def main():
     
     # Parse admin IDs
     admin_ids = []
-    if admin_ids_str:
-        for admin_id_str in admin_ids_str.split(','):
-            try:
-                admin_ids.append(int(admin_id_str.strip()))
-            except ValueError:
-                logger.warning(f"Invalid admin ID: {admin_id_str}")
+    for admin_id_str in admin_ids_str.split(','):
+        admin_id_str = admin_id_str.strip()
+        digits = admin_id_str[1:] if admin_id_str[:1] in ('-', '+') else admin_id_str
+        if digits.isdecimal():
+            admin_ids.append(int(admin_id_str))
+        elif admin_id_str:
+            logger.warning(f"Invalid admin ID: {admin_id_str}")
     
     if not admin_ids:
         logger.error("ADMIN_BOT_ADMIN_IDS must be set in .env file with at least one admin ID")
@@ -4,47 +4,113 @@ Provides in-memory caching for frequently accessed data
 For production, consider using Redis
 """
 
+import sys
 import time
+import heapq
 import threading
-from typing import Dict, Optional, Any, Callable
+from collections import OrderedDict, defaultdict
+from typing import Dict, Hashable, List, Optional, Any, Callable, Set, Tuple
 from datetime import datetime, timedelta
 import logging
 
+try:
+    from fastrlock.rlock import RLock
+except ImportError:
+    RLock = threading.RLock
+
 logger = logging.getLogger(__name__)
 
-class CacheEntry:
-    """Cache entry with expiration"""
-    def __init__(self, value: Any, ttl: int):
-        self.value = value
-        self.expires_at = time.time() + ttl
-        self.created_at = time.time()
-        self.access_count = 0
-        self.last_accessed = time.time()
+# Sentinel for single-probe dict lookups
+_MISSING = object()
+
+class _CacheShard:
+    """One independently locked partition of SimpleCache"""
+    
+    def __init__(self, max_size: int):
+        # key -> (value, expires_at); insertion order doubles as recency order
+        self.entries: 'OrderedDict[str, Tuple[Any, float]]' = OrderedDict()
+        # Min-heap of (expires_at, key); may hold stale pairs for overwritten keys
+        self.expiry_heap: List[Tuple[float, str]] = []
+        self.max_size = max_size
+        self.lock = RLock()
+    
+    def get(self, key: str, now: float) -> Any:
+        """Return the live entry for key, or _MISSING"""
+        with self.lock:
+            entry = self.entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                if now > entry[1]:
+                    self.entries.pop(key, None)
+                    return _MISSING
+                self.entries.move_to_end(key)
+            return entry
+    
+    def set(self, key: str, value: Any, now: float, expires_at: float) -> bool:
+        """Store entry; returns True if an LRU entry had to be evicted"""
+        evicted = False
+        with self.lock:
+            # Amortized expiry: drop what has expired before considering eviction;
+            # each heap pair is popped at most once
+            self.purge_expired(now)
+            
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            elif len(self.entries) >= self.max_size:
+                # Evict least recently used entry
+                self.entries.popitem(last=False)
+                evicted = True
+            
+            self.entries[key] = (value, expires_at)
+            heapq.heappush(self.expiry_heap, (expires_at, key))
+        return evicted
     
-    def is_expired(self) -> bool:
-        """Check if cache entry is expired"""
-        return time.time() > self.expires_at
+    def delete(self, key: str) -> bool:
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.expiry_heap.clear()
     
-    def access(self):
-        """Record access"""
-        self.access_count += 1
-        self.last_accessed = time.time()
+    def purge_expired(self, now: float) -> int:
+        """Pop expired heap pairs and drop their entries"""
+        with self.lock:
+            heap = self.expiry_heap
+            count = 0
+            while heap and heap[0][0] < now:
+                expires_at, key = heapq.heappop(heap)
+                entry = self.entries.get(key)
+                # Skip stale heap pairs left behind by overwritten or deleted keys
+                if entry is not None and entry[1] == expires_at:
+                    del self.entries[key]
+                    count += 1
+            return count
 
 class SimpleCache:
     """Simple in-memory cache with TTL support"""
     
-    def __init__(self, default_ttl: int = 300, max_size: int = 1000):
+    def __init__(self, default_ttl: int = 300, max_size: int = 1000, shards: int = 16):
         """
         Initialize cache
         
         Args:
             default_ttl: Default time-to-live in seconds (default: 5 minutes)
             max_size: Maximum number of entries (default: 1000)
+            shards: Number of independently locked partitions, a power of two (default: 16)
         """
-        self.cache: Dict[str, CacheEntry] = {}
+        if shards < 1 or shards & (shards - 1):
+            raise ValueError("shards must be a power of two")
+        # Keys are spread over shards by hash so concurrent threads rarely share a lock;
+        # max_size is enforced per shard, so the global bound is approximate
+        shard_size = max(1, -(-max_size // shards))
+        self._shards = [_CacheShard(shard_size) for _ in range(shards)]
+        self._shard_mask = shards - 1
+        # Reverse index tag -> keys, so related entries can be dropped without a key scan
+        self._tags: Dict[Hashable, Set[str]] = defaultdict(set)
+        self._tags_lock = RLock()
         self.default_ttl = default_ttl
         self.max_size = max_size
-        self.lock = threading.RLock()
         self.stats = {
             'hits': 0,
             'misses': 0,
@@ -53,92 +119,80 @@ class SimpleCache:
             'evictions': 0
         }
     
+    def _shard(self, key: str) -> _CacheShard:
+        return self._shards[hash(key) & self._shard_mask]
+    
     def get(self, key: str) -> Optional[Any]:
         """Get value from cache"""
-        with self.lock:
-            if key not in self.cache:
-                self.stats['misses'] += 1
-                return None
-            
-            entry = self.cache[key]
-            
-            if entry.is_expired():
-                del self.cache[key]
-                self.stats['misses'] += 1
-                return None
-            
-            entry.access()
-            self.stats['hits'] += 1
-            return entry.value
+        entry = self._shard(key).get(key, time.time())
+        
+        # Stats are advisory, so they are updated outside the shard lock
+        if entry is _MISSING:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return entry[0]
     
     def set(self, key: str, value: Any, ttl: Optional[int] = None) -> bool:
         """Set value in cache"""
-        with self.lock:
-            # Check if we need to evict
-            if len(self.cache) >= self.max_size and key not in self.cache:
-                self._evict_lru()
-            
-            ttl = ttl or self.default_ttl
-            self.cache[key] = CacheEntry(value, ttl)
-            self.stats['sets'] += 1
-            return True
+        ttl = ttl or self.default_ttl
+        now = time.time()
+        if self._shard(key).set(key, value, now, now + ttl):
+            self.stats['evictions'] += 1
+        self.stats['sets'] += 1
+        return True
     
     def delete(self, key: str) -> bool:
         """Delete key from cache"""
-        with self.lock:
-            if key in self.cache:
-                del self.cache[key]
-                self.stats['deletes'] += 1
-                return True
-            return False
+        deleted = self._shard(key).delete(key)
+        if deleted:
+            self.stats['deletes'] += 1
+        return deleted
+    
+    def set_with_tag(self, key: str, value: Any, tag: Hashable, ttl: Optional[int] = None) -> bool:
+        """Set value in cache and register key under tag for invalidate_tag"""
+        self.set(key, value, ttl)
+        with self._tags_lock:
+            self._tags[tag].add(key)
+        return True
+    
+    def invalidate_tag(self, tag: Hashable) -> int:
+        """Delete all keys registered under tag"""
+        with self._tags_lock:
+            keys = self._tags.pop(tag, ())
+        return sum(1 for key in keys if self.delete(key))
     
     def clear(self):
         """Clear all cache"""
-        with self.lock:
-            self.cache.clear()
-            self.stats = {
-                'hits': 0,
-                'misses': 0,
-                'sets': 0,
-                'deletes': 0,
-                'evictions': 0
-            }
+        for shard in self._shards:
+            shard.clear()
+        with self._tags_lock:
+            self._tags.clear()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'sets': 0,
+            'deletes': 0,
+            'evictions': 0
+        }
     
     def cleanup_expired(self):
         """Remove expired entries"""
-        with self.lock:
-            expired_keys = [
-                key for key, entry in self.cache.items()
-                if entry.is_expired()
-            ]
-            for key in expired_keys:
-                del self.cache[key]
-            return len(expired_keys)
-    
-    def _evict_lru(self):
-        """Evict least recently used entry"""
-        if not self.cache:
-            return
-        
-        lru_key = min(
-            self.cache.keys(),
-            key=lambda k: self.cache[k].last_accessed
-        )
-        del self.cache[lru_key]
-        self.stats['evictions'] += 1
+        now = time.time()
+        return sum(shard.purge_expired(now) for shard in self._shards)
     
     def get_stats(self) -> Dict[str, Any]:
         """Get cache statistics"""
-        with self.lock:
-            total_requests = self.stats['hits'] + self.stats['misses']
-            hit_rate = (self.stats['hits'] / total_requests * 100) if total_requests > 0 else 0
-            
-            return {
-                **self.stats,
-                'size': len(self.cache),
-                'max_size': self.max_size,
-                'hit_rate': round(hit_rate, 2)
-            }
+        stats = dict(self.stats)
+        total_requests = stats['hits'] + stats['misses']
+        hit_rate = (stats['hits'] / total_requests * 100) if total_requests > 0 else 0
+        
+        return {
+            **stats,
+            'size': sum(len(shard.entries) for shard in self._shards),
+            'max_size': self.max_size,
+            'hit_rate': round(hit_rate, 2)
+        }
     
     def get_or_set(self, key: str, func: Callable[[], Any], ttl: Optional[int] = None) -> Any:
         """
@@ -164,72 +218,120 @@ class SimpleCache:
 cache = SimpleCache(default_ttl=300, max_size=1000)
 
 # Cache key prefixes
-CACHE_PREFIX_USER = "user:"
-CACHE_PREFIX_PANEL = "panel:"
-CACHE_PREFIX_PRODUCT = "product:"
-CACHE_PREFIX_SERVICE = "service:"
-CACHE_PREFIX_STATS = "stats:"
+# (interned: non-identifier literals such as "user:" are not interned automatically)
+CACHE_PREFIX_USER = sys.intern("user:")
+CACHE_PREFIX_PANEL = sys.intern("panel:")
+CACHE_PREFIX_PRODUCT = sys.intern("product:")
+CACHE_PREFIX_SERVICE = sys.intern("service:")
+CACHE_PREFIX_STATS = sys.intern("stats:")
+CACHE_PREFIX_DISCOUNT_CODE = sys.intern("discount_code:")
+CACHE_PREFIX_GIFT_CODE = sys.intern("gift_code:")
+CACHE_PREFIX_BOT_TEXT = sys.intern("bot_text:")
+_CACHE_PREFIX_SERVICE_USER = sys.intern(CACHE_PREFIX_SERVICE + "user:")
+_CACHE_PREFIX_STATS_USER = sys.intern(CACHE_PREFIX_STATS + "user:")
+_CACHE_PREFIX_PRODUCTS_PANEL = sys.intern("products:panel:")
+_CACHE_KEY_PANELS_ACTIVE = sys.intern("panels:active")
+
+# Shared prefix for single-bot mode (no multi-bot isolation needed)
+_NO_BOT_PREFIX = ""
 
 def _get_bot_prefix() -> str:
     """Get bot prefix for cache keys (for multi-bot isolation)"""
     try:
         from flask import g, current_app
-        # Try Flask g first
-        if hasattr(g, 'bot_name') and g.bot_name:
-            return f"bot:{g.bot_name}:"
-        # Try app config
-        if hasattr(current_app, 'config') and 'BOT_NAME' in current_app.config:
-            bot_name = current_app.config.get('BOT_NAME')
-            if bot_name:
-                return f"bot:{bot_name}:"
+        # The prefix cannot change within a request, so memoize it on g
+        prefix = getattr(g, '_bot_cache_prefix', None)
+        if prefix is not None:
+            return prefix
+        
+        prefix = _NO_BOT_PREFIX
+        try:
+            bot_name = g.bot_name
+        except AttributeError:
+            bot_name = None
+        if not bot_name:
+            config = current_app.config
+            bot_name = config.get('BOT_NAME')
+        # Try Flask g first, then app config
+        if bot_name:
+            prefix = f"bot:{bot_name}:"
         # Try database name from config
-        if hasattr(current_app, 'config') and 'BOT_CONFIG' in current_app.config:
-            db_name = current_app.config.get('BOT_CONFIG', {}).get('database_name')
+        else:
+            db_name = (config.get('BOT_CONFIG') or {}).get('database_name')
             if db_name:
-                return f"db:{db_name}:"
-    except:
-        pass
-    # No bot prefix in single-bot mode
-    return ""
+                prefix = f"db:{db_name}:"
+        
+        # Intern so every request of the same bot shares one prefix object
+        prefix = sys.intern(prefix)
+        g._bot_cache_prefix = prefix
+        return prefix
+    except (ImportError, RuntimeError):
+        # Outside of a Flask app/request context: no bot prefix in single-bot mode
+        return _NO_BOT_PREFIX
 
+# Keys are built by plain concatenation; with the empty single-bot prefix
+# CPython returns the right operand as-is instead of building a new string
 def cache_key_user(user_id: int) -> str:
     """Generate cache key for user"""
-    bot_prefix = _get_bot_prefix()
-    return f"{bot_prefix}{CACHE_PREFIX_USER}{user_id}"
+    return _get_bot_prefix() + (CACHE_PREFIX_USER + str(user_id))
 
 def cache_key_panel(panel_id: int) -> str:
     """Generate cache key for panel"""
-    bot_prefix = _get_bot_prefix()
-    return f"{bot_prefix}{CACHE_PREFIX_PANEL}{panel_id}"
+    return _get_bot_prefix() + (CACHE_PREFIX_PANEL + str(panel_id))
 
 def cache_key_product(product_id: int) -> str:
     """Generate cache key for product"""
-    bot_prefix = _get_bot_prefix()
-    return f"{bot_prefix}{CACHE_PREFIX_PRODUCT}{product_id}"
+    return _get_bot_prefix() + (CACHE_PREFIX_PRODUCT + str(product_id))
 
 def cache_key_user_services(user_id: int) -> str:
     """Generate cache key for user services"""
-    bot_prefix = _get_bot_prefix()
-    return f"{bot_prefix}{CACHE_PREFIX_SERVICE}user:{user_id}"
+    return _get_bot_prefix() + (_CACHE_PREFIX_SERVICE_USER + str(user_id))
 
 def cache_key_stats(user_id: int) -> str:
     """Generate cache key for user stats"""
-    bot_prefix = _get_bot_prefix()
-    return f"{bot_prefix}{CACHE_PREFIX_STATS}user:{user_id}"
+    return _get_bot_prefix() + (_CACHE_PREFIX_STATS_USER + str(user_id))
 
 def cache_key_panels_active() -> str:
     """Generate cache key for active panels list"""
-    bot_prefix = _get_bot_prefix()
-    return f"{bot_prefix}panels:active"
+    return _get_bot_prefix() + _CACHE_KEY_PANELS_ACTIVE
+
+def cache_key_products_panel(panel_id: int, category_id: Optional[int] = None) -> str:
+    """Generate cache key for products of a panel, optionally of one category (0 = uncategorized)"""
+    key = _CACHE_PREFIX_PRODUCTS_PANEL + str(panel_id)
+    if category_id is not None:
+        key += ":category:" + str(category_id)
+    return _get_bot_prefix() + key
+
+def cache_tag_panel(panel_id: int) -> Tuple[str, str, int]:
+    """Generate cache tag grouping entries that depend on a panel"""
+    return (_get_bot_prefix(), 'panel', panel_id)
 
-def cache_key_products_panel(panel_id: int) -> str:
-    """Generate cache key for products of a panel"""
-    bot_prefix = _get_bot_prefix()
-    return f"{bot_prefix}products:panel:{panel_id}"
+def cache_key_discount_code(database_name: str, code: str) -> str:
+    """Generate cache key for a discount code row (code already normalized)"""
+    return CACHE_PREFIX_DISCOUNT_CODE + database_name + ":" + code
+
+def cache_key_gift_code(database_name: str, code: str) -> str:
+    """Generate cache key for a gift code row (code already normalized)"""
+    return CACHE_PREFIX_GIFT_CODE + database_name + ":" + code
+
+def cache_tag_discount_code(database_name: str, code_id: int) -> Tuple[str, str, int]:
+    """Generate cache tag for entries derived from a discount code row"""
+    return (database_name, 'discount_code', code_id)
+
+def cache_tag_gift_code(database_name: str, code_id: int) -> Tuple[str, str, int]:
+    """Generate cache tag for entries derived from a gift code row"""
+    return (database_name, 'gift_code', code_id)
+
+def cache_key_bot_text(database_name: str, text_key: str) -> str:
+    """Generate cache key for a raw (unformatted) bot text template"""
+    return CACHE_PREFIX_BOT_TEXT + database_name + ":" + text_key
+
+def cache_tag_bot_texts(database_name: str) -> Tuple[str, str]:
+    """Generate cache tag for all bot texts of a database"""
+    return (database_name, 'bot_text')
 
 def invalidate_user_cache(user_id: int):
     """Invalidate all cache entries for a user"""
-    bot_prefix = _get_bot_prefix()
     cache.delete(cache_key_user(user_id))
     cache.delete(cache_key_user_services(user_id))
     cache.delete(cache_key_stats(user_id))
@@ -237,27 +339,21 @@ def invalidate_user_cache(user_id: int):
 def invalidate_panel_cache(panel_id: int):
     """Invalidate all cache entries for a panel"""
     cache.delete(cache_key_panel(panel_id))
-    # Also invalidate related products
-    # Note: This is a simple implementation, for production use Redis with pattern matching
+    # Products-of-panel entries (one per category) are stored under the panel tag
+    cache.invalidate_tag(cache_tag_panel(panel_id))
 
 def invalidate_product_cache(product_id: int):
     """Invalidate cache entry for a product"""
     cache.delete(cache_key_product(product_id))
 
-# Background cleanup thread
-def cleanup_cache_periodically():
-    """Periodically clean up expired cache entries"""
-    import time
-    while True:
-        try:
-            time.sleep(60)  # Clean every minute
-            cleaned = cache.cleanup_expired()
-            if cleaned > 0:
-                logger.debug(f"Cleaned {cleaned} expired cache entries")
-        except Exception as e:
-            logger.error(f"Error in cache cleanup: {e}")
+def invalidate_discount_code_cache(database_name: str, code_id: int):
+    """Invalidate cached lookups of a discount code"""
+    cache.invalidate_tag(cache_tag_discount_code(database_name, code_id))
 
-# Start cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_cache_periodically, daemon=True)
-cleanup_thread.start()
+def invalidate_gift_code_cache(database_name: str, code_id: int):
+    """Invalidate cached lookups of a gift code"""
+    cache.invalidate_tag(cache_tag_gift_code(database_name, code_id))
 
+def invalidate_bot_text_cache(database_name: str):
+    """Invalidate cached bot texts of a database"""
+    cache.invalidate_tag(cache_tag_bot_texts(database_name))
@@ -3,6 +3,9 @@ Country Name Translator - English to Persian
 Automatically translates country names from English to Persian
 """
 
+import re
+from functools import lru_cache
+
 COUNTRY_NAMES = {
     # Major countries
     'germany': 'آلمان',
@@ -88,6 +91,17 @@ COUNTRY_NAMES = {
     'new zealand': 'نیوزیلند',
 }
 
+# Single-pass matcher for partial matches; longer names first so that
+# e.g. "ukraine" wins over "uk" at the same position
+_COUNTRY_PATTERN = re.compile(
+    '|'.join(re.escape(name) for name in sorted(COUNTRY_NAMES, key=len, reverse=True))
+)
+
+_MIN_COUNTRY_NAME_LENGTH = min(len(name) for name in COUNTRY_NAMES)
+
+# Emojis and punctuation stripped from panel names before translation
+_NON_WORD_PATTERN = re.compile(r'[^\w\s]+')
+
 
 def translate_country(english_name: str) -> str:
     """
@@ -110,14 +124,17 @@ def translate_country(english_name: str) -> str:
         return COUNTRY_NAMES[name_lower]
     
     # Partial match (for names like "Germany 1", "USA West", etc.)
-    for eng, per in COUNTRY_NAMES.items():
-        if eng in name_lower:
-            return per
+    if len(name_lower) >= _MIN_COUNTRY_NAME_LENGTH:
+        match = _COUNTRY_PATTERN.search(name_lower)
+        if match:
+            return COUNTRY_NAMES[match.group(0)]
     
     # If no match found, return original name
     return english_name
 
 
+# Panel names form a small, stable set, so repeated renders are served from here
+@lru_cache(maxsize=256)
 def extract_country_from_panel_name(panel_name: str) -> str:
     """
     Extract and translate country name from panel name
@@ -132,8 +149,7 @@ def extract_country_from_panel_name(panel_name: str) -> str:
         return 'نامشخص'
     
     # Remove emojis and extra characters
-    import re
-    cleaned_name = re.sub(r'[^\w\s]', ' ', panel_name)
+    cleaned_name = _NON_WORD_PATTERN.sub(' ', panel_name)
     
     # Try to translate
     return translate_country(cleaned_name)
@@ -4,10 +4,15 @@ Adds indexes and optimizes frequently used queries
 """
 
 import logging
+import re
 from typing import List, Dict, Optional
 
 logger = logging.getLogger(__name__)
 
+_CREATE_INDEX_PATTERN = re.compile(
+    r'CREATE INDEX (?:IF NOT EXISTS )?(\w+) ON (\w+)', re.IGNORECASE
+)
+
 def create_database_indexes(db_manager):
     """
     Create database indexes for better query performance
@@ -28,7 +33,9 @@ def create_database_indexes(db_manager):
                 "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)",
                 
                 # Clients table indexes
-                "CREATE INDEX IF NOT EXISTS idx_clients_user_id ON clients(user_id)",
+                # Serves optimize_services_query's WHERE + ORDER BY without a filesort;
+                # its user_id prefix also covers plain user_id lookups
+                "CREATE INDEX IF NOT EXISTS idx_clients_user_active_created ON clients(user_id, is_active, created_at DESC)",
                 "CREATE INDEX IF NOT EXISTS idx_clients_panel_id ON clients(panel_id)",
                 "CREATE INDEX IF NOT EXISTS idx_clients_is_active ON clients(is_active)",
                 "CREATE INDEX IF NOT EXISTS idx_clients_status ON clients(status)",
@@ -59,19 +66,35 @@ def create_database_indexes(db_manager):
                 # Discount codes indexes
                 "CREATE INDEX IF NOT EXISTS idx_discount_codes_code ON discount_codes(code)",
                 "CREATE INDEX IF NOT EXISTS idx_discount_codes_is_active ON discount_codes(is_active)",
+                # Range scans over the validity window of active codes
+                "CREATE INDEX IF NOT EXISTS idx_discount_codes_active_valid_until ON discount_codes(is_active, valid_until)",
                 
                 # Gift codes indexes
                 "CREATE INDEX IF NOT EXISTS idx_gift_codes_code ON gift_codes(code)",
                 "CREATE INDEX IF NOT EXISTS idx_gift_codes_is_active ON gift_codes(is_active)",
+                "CREATE INDEX IF NOT EXISTS idx_gift_codes_active_valid_until ON gift_codes(is_active, valid_until)",
             ]
             
+            # Look up existing indexes in one round-trip instead of issuing
+            # a CREATE INDEX per index on every startup
+            cursor.execute('''
+                SELECT DISTINCT TABLE_NAME, INDEX_NAME
+                FROM information_schema.statistics
+                WHERE TABLE_SCHEMA = DATABASE()
+            ''')
+            existing = {(table.lower(), name.lower()) for table, name in cursor.fetchall()}
+            
             for index_sql in indexes:
+                index_name, table_name = _CREATE_INDEX_PATTERN.match(index_sql).groups()
+                if (table_name.lower(), index_name.lower()) in existing:
+                    continue
                 try:
-                    cursor.execute(index_sql)
+                    # MySQL does not support IF NOT EXISTS here; existence is checked above
+                    cursor.execute(index_sql.replace(' IF NOT EXISTS', '', 1))
                     logger.info(f"Created index: {index_sql[:50]}...")
                 except Exception as e:
-                    # Index might already exist, ignore error
-                    logger.debug(f"Index creation skipped (might exist): {e}")
+                    # Table or column might not exist, ignore error
+                    logger.debug(f"Index creation skipped: {e}")
             
             conn.commit()
             logger.info("✅ Database indexes created successfully")
@@ -80,6 +103,31 @@ def create_database_indexes(db_manager):
         logger.error(f"Error creating database indexes: {e}")
         # Don't raise - indexes are optional optimizations
 
+# Query texts are built once at import; the LIMIT variant is not re-concatenated per call
+_USER_QUERY = '''
+    SELECT id, telegram_id, username, first_name, last_name, 
+           balance, is_admin, referral_code, created_at, last_activity
+    FROM users 
+    WHERE telegram_id = %s
+    LIMIT 1
+'''
+
+_SERVICES_QUERY = '''
+    SELECT c.id, c.client_name, c.client_uuid, c.inbound_id, 
+           c.protocol, c.total_gb, c.expire_days, c.expires_at,
+           c.cached_used_gb as used_gb, c.cached_is_online as is_online,
+           c.cached_last_activity as last_activity, c.sub_id,
+           c.config_link, c.is_active, c.status,
+           p.name as panel_name, p.panel_type
+    FROM clients c
+    LEFT JOIN panels p ON c.panel_id = p.id
+    WHERE c.user_id = (SELECT id FROM users WHERE telegram_id = %s LIMIT 1)
+      AND c.is_active = 1
+    ORDER BY c.created_at DESC
+'''
+
+_SERVICES_QUERY_LIMITED = _SERVICES_QUERY + ' LIMIT %s'
+
 def optimize_user_query(db_manager, user_id: int) -> Optional[Dict]:
     """
     Optimized user query - returns only essential fields
@@ -87,13 +135,7 @@ def optimize_user_query(db_manager, user_id: int) -> Optional[Dict]:
     try:
         with db_manager.get_connection() as conn:
             cursor = conn.cursor(dictionary=True)
-            cursor.execute('''
-                SELECT id, telegram_id, username, first_name, last_name, 
-                       balance, is_admin, referral_code, created_at, last_activity
-                FROM users 
-                WHERE telegram_id = %s
-                LIMIT 1
-            ''', (user_id,))
+            cursor.execute(_USER_QUERY, (user_id,))
             return cursor.fetchone()
     except Exception as e:
         logger.error(f"Error in optimized user query: {e}")
@@ -104,42 +146,22 @@ def optimize_services_query(db_manager, user_id: int, limit: Optional[int] = Non
     Optimized services query - returns only essential fields with JOIN
     """
     try:
-        user = db_manager.get_user(user_id)
-        if not user:
-            return []
-        
-        db_user_id = user['id']
-        
         with db_manager.get_connection() as conn:
             cursor = conn.cursor(dictionary=True)
-            query = '''
-                SELECT c.id, c.client_name, c.client_uuid, c.inbound_id, 
-                       c.protocol, c.total_gb, c.expire_days, c.expires_at,
-                       c.cached_used_gb as used_gb, c.cached_is_online as is_online,
-                       c.cached_last_activity as last_activity, c.sub_id,
-                       c.config_link, c.is_active, c.status,
-                       p.name as panel_name, p.panel_type
-                FROM clients c
-                LEFT JOIN panels p ON c.panel_id = p.id
-                WHERE c.user_id = %s AND c.is_active = 1
-                ORDER BY c.created_at DESC
-            '''
             # SECURITY: Validate and use parameterized query for LIMIT
             if limit:
                 # Validate limit is a positive integer
                 try:
                     limit_int = int(limit)
                     if limit_int > 0 and limit_int <= 1000:  # Max limit
-                        query += ' LIMIT %s'
-                        cursor.execute(query, (db_user_id, limit_int))
+                        cursor.execute(_SERVICES_QUERY_LIMITED, (user_id, limit_int))
                     else:
-                        cursor.execute(query, (db_user_id,))
+                        cursor.execute(_SERVICES_QUERY, (user_id,))
                 except (ValueError, TypeError):
-                    cursor.execute(query, (db_user_id,))
+                    cursor.execute(_SERVICES_QUERY, (user_id,))
             else:
-                cursor.execute(query, (db_user_id,))
+                cursor.execute(_SERVICES_QUERY, (user_id,))
             return cursor.fetchall()
     except Exception as e:
         logger.error(f"Error in optimized services query: {e}")
         return []
-
@@ -4,12 +4,146 @@ Handles discount codes and gift codes with comprehensive validation and applicat
 """
 
 import logging
-from typing import Dict, Optional, Tuple
+from functools import wraps
+from typing import Dict, Iterator, List, Optional, Tuple
 from datetime import datetime, timedelta
 from professional_database import ProfessionalDatabaseManager
+from cache_utils import (
+    cache, cache_key_discount_code, cache_key_gift_code,
+    cache_tag_discount_code, cache_tag_gift_code, invalidate_discount_code_cache
+)
 
 logger = logging.getLogger(__name__)
 
+# Code rows change rarely; mutations through ProfessionalDatabaseManager invalidate
+# them in-process, and the TTL bounds staleness across bot/webapp processes
+CODE_CACHE_TTL = 60
+
+def get_cached_discount_code(db: ProfessionalDatabaseManager, code: str) -> Optional[Dict]:
+    """Get discount code row by code string, served from cache when possible"""
+    code = str(code).strip().upper()
+    key = cache_key_discount_code(db.database_name, code)
+    discount_code = cache.get(key)
+    if discount_code is None:
+        discount_code = db.get_discount_code(code)
+        if discount_code:
+            cache.set_with_tag(key, discount_code,
+                               cache_tag_discount_code(db.database_name, discount_code['id']),
+                               ttl=CODE_CACHE_TTL)
+    return discount_code
+
+def get_cached_gift_code(db: ProfessionalDatabaseManager, code: str) -> Optional[Dict]:
+    """Get gift code row by code string, served from cache when possible"""
+    code = str(code).strip().upper()
+    key = cache_key_gift_code(db.database_name, code)
+    gift_code = cache.get(key)
+    if gift_code is None:
+        gift_code = db.get_gift_code(code)
+        if gift_code:
+            cache.set_with_tag(key, gift_code,
+                               cache_tag_gift_code(db.database_name, gift_code['id']),
+                               ttl=CODE_CACHE_TTL)
+    return gift_code
+
+def _percentage_basis_points(discount_value) -> int:
+    """Percentage (int, float or DECIMAL(10,2)) as integer hundredths of a percent"""
+    if isinstance(discount_value, int):
+        return discount_value * 100
+    return int(round(discount_value * 100))
+
+def _percentage_discount(discount_value: float, max_discount_amount: Optional[int], amount: int) -> int:
+    # Integer-only arithmetic: no float rounding drift on large amounts
+    discount_amount = amount * _percentage_basis_points(discount_value) // 10000
+    # Apply max discount limit if exists
+    if max_discount_amount and discount_amount > max_discount_amount:
+        return max_discount_amount
+    return discount_amount
+
+def _fixed_discount(discount_value: float, max_discount_amount: Optional[int], amount: int) -> int:
+    discount_amount = int(discount_value)
+    # Can't discount more than the amount
+    return amount if discount_amount > amount else discount_amount
+
+# discount_type -> calculator; unknown types give no discount
+_DISCOUNT_CALCULATORS = {
+    'percentage': _percentage_discount,
+    'fixed': _fixed_discount,
+}
+
+def _compute_discount_amount(discount_type: str, discount_value: float,
+                             max_discount_amount: Optional[int], amount: int) -> int:
+    """Discount for amount from already-unpacked code fields (scalar arithmetic only)"""
+    calculator = _DISCOUNT_CALCULATORS.get(discount_type)
+    return calculator(discount_value, max_discount_amount, amount) if calculator else 0
+
+# Statements shared by the single and bulk invoice discount paths
+_UPDATE_INVOICE_DISCOUNT_SQL = '''
+    UPDATE invoices 
+    SET discount_code_id = %s, 
+        discount_amount = %s,
+        original_amount = %s,
+        amount = %s
+    WHERE id = %s
+'''
+
+_UPDATE_USER_INVOICE_DISCOUNT_SQL = _UPDATE_INVOICE_DISCOUNT_SQL + '      AND user_id = %s\n'
+
+# Only the first of concurrent applies to the same invoice matches
+_UPDATE_UNDISCOUNTED_INVOICE_SQL = _UPDATE_INVOICE_DISCOUNT_SQL + '      AND discount_code_id IS NULL\n'
+
+_SELECT_CLAIMABLE_INVOICES_SQL = '''
+    SELECT id FROM invoices
+    WHERE user_id = %s AND discount_code_id IS NULL AND id IN ({placeholders})
+    FOR UPDATE
+'''
+
+_INSERT_DISCOUNT_USAGE_SQL = '''
+    INSERT INTO discount_code_usage
+    (code_id, user_id, invoice_id, amount_before_discount, discount_amount, amount_after_discount)
+    VALUES (%s, %s, %s, %s, %s, %s)
+'''
+
+_INCREMENT_DISCOUNT_USED_COUNT_SQL = '''
+    UPDATE discount_codes SET used_count = used_count + %s
+    WHERE id = %s
+'''
+
+_LOCK_DISCOUNT_CODE_SQL = '''
+    SELECT used_count, max_uses, is_active FROM discount_codes
+    WHERE id = %s
+    FOR UPDATE
+'''
+
+# Takes one use only while the code is active and under max_uses (0 = unlimited)
+_CLAIM_DISCOUNT_USE_SQL = '''
+    UPDATE discount_codes SET used_count = used_count + 1
+    WHERE id = %s AND is_active = 1 AND (max_uses = 0 OR used_count < max_uses)
+'''
+
+# Same upper bound as security_utils.validate_discount_code
+_MAX_CODE_LENGTH = 50
+
+# Success message fragments; amounts are grouped with format(amount, ',d') so callers
+# that localize digits always see the same "<prefix><grouped digits><suffix>" shape
+_MSG_DISCOUNT_PREFIX = 'کد تخفیف اعمال شد! تخفیف: '
+_MSG_TOMAN_SUFFIX = ' تومان'
+_MSG_GIFT_PREFIX = 'کد هدیه با موفقیت اعمال شد! '
+_MSG_GIFT_SUFFIX = ' تومان به حساب شما اضافه شد.'
+
+def _normalize_code(code) -> Optional[str]:
+    """
+    Normalize a user-entered discount/gift code, or return None if it is malformed
+    
+    Codes are letters/digits with optional '_' or '-'; malformed input is rejected
+    here so it never reaches the cache or the database.
+    """
+    code = str(code or "").strip().upper()
+    if not code or len(code) > _MAX_CODE_LENGTH:
+        return None
+    if not code.replace("_", "").replace("-", "").isalnum():
+        return None
+    return code
+
 class DiscountCodeManager:
     """Manages discount codes and gift codes"""
     
@@ -23,46 +157,100 @@ class DiscountCodeManager:
         Returns:
             Tuple[discount_amount, final_amount]
         """
-        discount_type = discount_code['discount_type']
+        discount_amount = _compute_discount_amount(
+            discount_code['discount_type'],
+            discount_code['discount_value'],
+            discount_code.get('max_discount_amount'),
+            amount
+        )
+        final_amount = amount - discount_amount if amount > discount_amount else 0
+        return discount_amount, final_amount
+    
+    def calculate_discount_batch(self, discount_code: Dict, amounts: List[int]) -> Tuple[List[int], List[int]]:
+        """
+        Calculate discounts for many amounts with the same discount code
+        
+        Code fields are unpacked once; each amount goes through the same
+        calculator as calculate_discount.
+        
+        Returns:
+            Tuple[discount_amounts, final_amounts]
+        """
         discount_value = discount_code['discount_value']
+        max_discount_amount = discount_code.get('max_discount_amount')
+        calculator = _DISCOUNT_CALCULATORS.get(discount_code['discount_type'])
         
-        if discount_type == 'percentage':
-            discount_amount = int((amount * discount_value) / 100)
-            # Apply max discount limit if exists
-            if discount_code['max_discount_amount']:
-                discount_amount = min(discount_amount, discount_code['max_discount_amount'])
-        elif discount_type == 'fixed':
-            discount_amount = int(discount_value)
-            # Can't discount more than the amount
-            discount_amount = min(discount_amount, amount)
+        if calculator:
+            discounts = [calculator(discount_value, max_discount_amount, amount) for amount in amounts]
         else:
-            discount_amount = 0
+            discounts = [0] * len(amounts)
         
-        final_amount = max(0, amount - discount_amount)
-        return discount_amount, final_amount
+        finals = [amount - discount if amount > discount else 0 for amount, discount in zip(amounts, discounts)]
+        return discounts, finals
     
-    def validate_and_apply_discount(self, code: str, user_id: int, amount: int) -> Dict:
+    def validate_and_apply_discount(self, code: str, user_id: int, amount: int,
+                                    now: Optional[datetime] = None,
+                                    include_code: bool = False) -> Dict:
         """
         Validate discount code and return discount details
         
+        `now` is the reference time for the validity window; it is taken once
+        here and shared by the pre-check and the database validation, which
+        reuses the code row fetched for the pre-check.
+        The full discount code row is attached under 'discount_code' only when
+        `include_code` is set.
+        
         Returns:
             Dict with success status, message, discount_amount, final_amount, and code details
         """
+        _, result = self._validate_discount(code, user_id, amount, now, include_code)
+        return result
+    
+    def _validate_discount(self, code: str, user_id: int, amount: int,
+                           now: Optional[datetime] = None,
+                           include_code: bool = False) -> Tuple[Optional[int], Dict]:
+        """
+        validate_and_apply_discount, also returning the user's database ID
+        
+        The ID is kept out of the result dict, which callers may send to clients as-is.
+        Returns (db_user_id, result); db_user_id is None when validation fails.
+        """
+        code = _normalize_code(code)
+        if code is None:
+            return None, {
+                'success': False,
+                'message': 'کد نامعتبر'
+            }
+        
+        if now is None:
+            now = datetime.now()
+        
+        # Fast reject from the cached code row (missing, inactive, expired, exhausted,
+        # below minimum purchase) before any user lookup or usage query
+        discount_code = get_cached_discount_code(self.db, code)
+        error_message = self.db.check_discount_code_rules(discount_code, amount, now)
+        if error_message:
+            return None, {
+                'success': False,
+                'message': error_message
+            }
+        
         # Get user database ID
         user = self.db.get_user(user_id)
         if not user:
-            return {
+            return None, {
                 'success': False,
                 'message': 'کاربر یافت نشد'
             }
         
         db_user_id = user['id']
         
-        # Validate discount code
-        is_valid, error_message, discount_code = self.db.validate_discount_code(code, db_user_id, amount)
+        # Validate discount code against a fresh row: the cached one may be stale
+        # across processes, so it is only trusted to reject
+        is_valid, error_message, discount_code = self.db.validate_discount_code(code, db_user_id, amount, now)
         
         if not is_valid:
-            return {
+            return None, {
                 'success': False,
                 'message': error_message
             }
@@ -70,16 +258,18 @@ class DiscountCodeManager:
         # Calculate discount
         discount_amount, final_amount = self.calculate_discount(discount_code, amount)
         
-        return {
+        result = {
             'success': True,
-            'message': f'کد تخفیف اعمال شد! تخفیف: {discount_amount:,} تومان',
+            'message': _MSG_DISCOUNT_PREFIX + format(discount_amount, ',d') + _MSG_TOMAN_SUFFIX,
             'discount_amount': discount_amount,
             'final_amount': final_amount,
             'original_amount': amount,
             'code_id': discount_code['id'],
-            'code': discount_code['code'],
-            'discount_code': discount_code
+            'code': discount_code['code']
         }
+        if include_code:
+            result['discount_code'] = discount_code
+        return db_user_id, result
     
     def apply_discount_to_invoice(self, code: str, user_id: int, invoice_id: int, amount: int) -> Dict:
         """
@@ -89,52 +279,181 @@ class DiscountCodeManager:
             Dict with success status and updated invoice details
         """
         # Validate discount
-        validation_result = self.validate_and_apply_discount(code, user_id, amount)
+        db_user_id, validation_result = self._validate_discount(code, user_id, amount)
         
         if not validation_result['success']:
             return validation_result
         
-        # Get user database ID
+        # Claim the invoice with a conditional UPDATE first, then record usage in
+        # the same transaction; only the caller whose UPDATE matched records usage
+        try:
+            with self.db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(_UPDATE_UNDISCOUNTED_INVOICE_SQL, (
+                    validation_result['code_id'],
+                    validation_result['discount_amount'],
+                    amount,
+                    validation_result['final_amount'],
+                    invoice_id
+                ))
+                
+                if cursor.rowcount == 0:
+                    # Distinguish a missing invoice from one that already has a discount
+                    cursor.execute('SELECT id FROM invoices WHERE id = %s', (invoice_id,))
+                    invoice_exists = cursor.fetchone() is not None
+                    conn.rollback()
+                    return {
+                        'success': False,
+                        'message': 'کد تخفیف قبلاً روی این فاکتور اعمال شده است' if invoice_exists else 'فاکتور یافت نشد'
+                    }
+                
+                cursor.execute(_INSERT_DISCOUNT_USAGE_SQL, (
+                    validation_result['code_id'],
+                    db_user_id,
+                    invoice_id,
+                    amount,
+                    validation_result['discount_amount'],
+                    validation_result['final_amount']
+                ))
+                
+                # The code may have been deactivated or used up since validation
+                cursor.execute(_CLAIM_DISCOUNT_USE_SQL, (validation_result['code_id'],))
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    invalidate_discount_code_cache(self.db.database_name, validation_result['code_id'])
+                    return {
+                        'success': False,
+                        'message': 'کد تخفیف غیرفعال شده یا ظرفیت استفاده از آن به پایان رسیده است'
+                    }
+                
+                conn.commit()
+            invalidate_discount_code_cache(self.db.database_name, validation_result['code_id'])
+        except Exception as e:
+            logger.error("Error applying discount to invoice: %s", e)
+            return {
+                'success': False,
+                'message': 'خطا در ثبت استفاده از کد تخفیف'
+            }
+        
+        return validation_result
+    
+    def apply_discount_code_bulk(self, code: str, user_id: int, items: List[Tuple[int, int]]) -> Dict:
+        """
+        Apply one discount code to many invoices of a user (e.g. retroactive promo runs)
+        
+        The code is validated once, discounts are computed in one batch and all
+        writes happen in a single transaction.
+        
+        Args:
+            items: List of (invoice_id, amount)
+        
+        Returns:
+            Dict with success status, applied/skipped invoice ids and total discount
+        """
+        if not items:
+            return {
+                'success': False,
+                'message': 'هیچ فاکتوری برای اعمال تخفیف ارسال نشده است'
+            }
+        
+        code = _normalize_code(code)
+        if code is None:
+            return {
+                'success': False,
+                'message': 'کد نامعتبر'
+            }
+        
         user = self.db.get_user(user_id)
+        if not user:
+            return {
+                'success': False,
+                'message': 'کاربر یافت نشد'
+            }
+        
         db_user_id = user['id']
         
-        # Record discount usage
-        success = self.db.apply_discount_code(
-            code_id=validation_result['code_id'],
-            user_id=db_user_id,
-            invoice_id=invoice_id,
-            amount_before=amount,
-            discount_amount=validation_result['discount_amount'],
-            amount_after=validation_result['final_amount']
+        # Validate against the largest amount; smaller ones are filtered by min purchase below
+        is_valid, error_message, discount_code = self.db.validate_discount_code(
+            code, db_user_id, max(amount for _, amount in items)
         )
         
-        if not success:
+        if not is_valid:
             return {
                 'success': False,
-                'message': 'خطا در ثبت استفاده از کد تخفیف'
+                'message': error_message
             }
         
-        # Update invoice with discount
-        invoice = self.db.get_invoice(invoice_id)
-        if invoice:
-            # Update invoice amount
+        min_purchase = discount_code['min_purchase_amount'] or 0
+        eligible = [(invoice_id, amount) for invoice_id, amount in items if amount >= min_purchase]
+        
+        code_id = discount_code['id']
+        
+        try:
             with self.db.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                    UPDATE invoices 
-                    SET discount_code_id = ?, 
-                        discount_amount = ?,
-                        original_amount = ?,
-                        amount = ?
-                    WHERE id = ?
-                ''', (validation_result['code_id'], 
-                      validation_result['discount_amount'],
-                      amount,
-                      validation_result['final_amount'],
-                      invoice_id))
+                
+                # One locking SELECT replaces a per-invoice existence check: keeps only
+                # the user's invoices that exist and have no discount yet
+                if eligible:
+                    placeholders = ', '.join(['%s'] * len(eligible))
+                    cursor.execute(
+                        _SELECT_CLAIMABLE_INVOICES_SQL.format(placeholders=placeholders),
+                        [db_user_id] + [invoice_id for invoice_id, _ in eligible]
+                    )
+                    claimable = {row[0] for row in cursor.fetchall()}
+                    eligible = [item for item in eligible if item[0] in claimable]
+                
+                # Respect the remaining use budget of the code, read under a row lock so
+                # concurrent runs cannot both spend it
+                cursor.execute(_LOCK_DISCOUNT_CODE_SQL, (code_id,))
+                used_count, max_uses, is_active = cursor.fetchone() or (0, 0, 0)
+                if not is_active:
+                    eligible = []
+                elif max_uses > 0:
+                    eligible = eligible[:max(0, max_uses - used_count)]
+                
+                if not eligible:
+                    conn.rollback()
+                    return {
+                        'success': False,
+                        'message': 'هیچ فاکتوری شرایط استفاده از این کد تخفیف را ندارد'
+                    }
+                
+                amounts = [amount for _, amount in eligible]
+                discounts, finals = self.calculate_discount_batch(discount_code, amounts)
+                priced = list(zip(eligible, discounts, finals))
+                cursor.executemany(_UPDATE_USER_INVOICE_DISCOUNT_SQL, [
+                    (code_id, discount, amount, final, invoice_id, db_user_id)
+                    for (invoice_id, amount), discount, final in priced
+                ])
+                cursor.executemany(_INSERT_DISCOUNT_USAGE_SQL, [
+                    (code_id, db_user_id, invoice_id, amount, discount, final)
+                    for (invoice_id, amount), discount, final in priced
+                ])
+                
+                cursor.execute(_INCREMENT_DISCOUNT_USED_COUNT_SQL, (len(eligible), code_id))
+                
                 conn.commit()
+            invalidate_discount_code_cache(self.db.database_name, code_id)
+        except Exception as e:
+            logger.error("Error applying discount code in bulk: %s", e)
+            return {
+                'success': False,
+                'message': 'خطا در ثبت استفاده از کد تخفیف'
+            }
         
-        return validation_result
+        applied_ids = [invoice_id for invoice_id, _ in eligible]
+        applied_set = set(applied_ids)
+        total_discount = sum(discounts)
+        return {
+            'success': True,
+            'message': f'کد تخفیف روی {len(applied_ids)} فاکتور اعمال شد! مجموع تخفیف: {total_discount:,} تومان',
+            'applied_invoice_ids': applied_ids,
+            'skipped_invoice_ids': [invoice_id for invoice_id, _ in items if invoice_id not in applied_set],
+            'total_discount': total_discount,
+            'code_id': code_id,
+            'code': discount_code['code']
+        }
     
     def validate_and_apply_gift_code(self, code: str, user_id: int) -> Dict:
         """
@@ -143,6 +462,13 @@ class DiscountCodeManager:
         Returns:
             Dict with success status and gift amount
         """
+        code = _normalize_code(code)
+        if code is None:
+            return {
+                'success': False,
+                'message': 'کد نامعتبر'
+            }
+        
         # Get user database ID
         user = self.db.get_user(user_id)
         if not user:
@@ -173,18 +499,45 @@ class DiscountCodeManager:
         
         return {
             'success': True,
-            'message': f'کد هدیه با موفقیت اعمال شد! {gift_code["amount"]:,} تومان به حساب شما اضافه شد.',
+            'message': _MSG_GIFT_PREFIX + format(gift_code['amount'], ',d') + _MSG_GIFT_SUFFIX,
             'amount': gift_code['amount'],
             'code': gift_code['code']
         }
     
+    def iter_active_discount_codes(self) -> Iterator[Dict]:
+        """Stream active discount codes with usage statistics (for paginated admin listings)"""
+        return self.db.iter_all_discount_codes_with_stats(active_only=True)
+    
+    def iter_active_gift_codes(self) -> Iterator[Dict]:
+        """Stream active gift codes with usage statistics (for paginated admin listings)"""
+        return self.db.iter_all_gift_codes_with_stats(active_only=True)
+    
     def get_active_discount_codes(self) -> list:
-        """Get all active discount codes"""
-        return self.db.get_all_discount_codes(active_only=True)
+        """Get all active discount codes, including usage statistics"""
+        return list(self.iter_active_discount_codes())
     
     def get_active_gift_codes(self) -> list:
-        """Get all active gift codes"""
-        return self.db.get_all_gift_codes(active_only=True)
+        """Get all active gift codes, including usage statistics"""
+        return list(self.iter_active_gift_codes())
+
+
+def _handle_db_errors(error_message: str):
+    """
+    Decorator for admin operations returning Tuple[success, message]
+    
+    Unexpected exceptions are logged with traceback and reported as the generic
+    `error_message`, so database internals never reach the admin UI.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                logger.exception("Error in %s", func.__name__)
+                return False, error_message
+        return wrapper
+    return decorator
 
 
 class DiscountCodeAdmin:
@@ -193,6 +546,7 @@ class DiscountCodeAdmin:
     def __init__(self, db: ProfessionalDatabaseManager):
         self.db = db
     
+    @_handle_db_errors("خطا در ایجاد کد تخفیف")
     def create_discount_code(self, code: str, discount_type: str, discount_value: float,
                             max_discount_amount: Optional[int] = None,
                             min_purchase_amount: int = 0,
@@ -209,36 +563,32 @@ class DiscountCodeAdmin:
         Returns:
             Tuple[success, message]
         """
-        try:
-            # Check if code already exists
-            existing = self.db.get_discount_code(code)
-            if existing:
-                return False, f"کد تخفیف '{code}' از قبل وجود دارد"
-            
-            code_id = self.db.create_discount_code(
-                code=code,
-                discount_type=discount_type,
-                discount_value=discount_value,
-                max_discount_amount=max_discount_amount,
-                min_purchase_amount=min_purchase_amount,
-                max_uses=max_uses,
-                valid_from=valid_from,
-                valid_until=valid_until,
-                applicable_to=applicable_to,
-                created_by=created_by,
-                description=description,
-                notes=notes
-            )
-            
-            if code_id:
-                return True, f"کد تخفیف '{code}' با موفقیت ایجاد شد"
-            else:
-                return False, "خطا در ایجاد کد تخفیف"
-                
-        except Exception as e:
-            logger.error(f"Error creating discount code: {e}")
-            return False, f"خطا در ایجاد کد تخفیف: {str(e)}"
+        # Check if code already exists
+        existing = get_cached_discount_code(self.db, code)
+        if existing:
+            return False, f"کد تخفیف '{code}' از قبل وجود دارد"
+        
+        code_id = self.db.create_discount_code(
+            code=code,
+            discount_type=discount_type,
+            discount_value=discount_value,
+            max_discount_amount=max_discount_amount,
+            min_purchase_amount=min_purchase_amount,
+            max_uses=max_uses,
+            valid_from=valid_from,
+            valid_until=valid_until,
+            applicable_to=applicable_to,
+            created_by=created_by,
+            description=description,
+            notes=notes
+        )
+        
+        if code_id:
+            return True, f"کد تخفیف '{code}' با موفقیت ایجاد شد"
+        else:
+            return False, "خطا در ایجاد کد تخفیف"
     
+    @_handle_db_errors("خطا در ایجاد کد هدیه")
     def create_gift_code(self, code: str, amount: int,
                         max_uses: int = 1,
                         valid_from: Optional[datetime] = None,
@@ -252,55 +602,44 @@ class DiscountCodeAdmin:
         Returns:
             Tuple[success, message]
         """
-        try:
-            # Check if code already exists
-            existing = self.db.get_gift_code(code)
-            if existing:
-                return False, f"کد هدیه '{code}' از قبل وجود دارد"
-            
-            code_id = self.db.create_gift_code(
-                code=code,
-                amount=amount,
-                max_uses=max_uses,
-                valid_from=valid_from,
-                valid_until=valid_until,
-                created_by=created_by,
-                description=description,
-                notes=notes
-            )
-            
-            if code_id:
-                return True, f"کد هدیه '{code}' با موفقیت ایجاد شد"
-            else:
-                return False, "خطا در ایجاد کد هدیه"
-                
-        except Exception as e:
-            logger.error(f"Error creating gift code: {e}")
-            return False, f"خطا در ایجاد کد هدیه: {str(e)}"
+        # Check if code already exists
+        existing = get_cached_gift_code(self.db, code)
+        if existing:
+            return False, f"کد هدیه '{code}' از قبل وجود دارد"
+        
+        code_id = self.db.create_gift_code(
+            code=code,
+            amount=amount,
+            max_uses=max_uses,
+            valid_from=valid_from,
+            valid_until=valid_until,
+            created_by=created_by,
+            description=description,
+            notes=notes
+        )
+        
+        if code_id:
+            return True, f"کد هدیه '{code}' با موفقیت ایجاد شد"
+        else:
+            return False, "خطا در ایجاد کد هدیه"
     
+    @_handle_db_errors("خطا در بروزرسانی کد تخفیف")
     def update_discount_code(self, code_id: int, **kwargs) -> Tuple[bool, str]:
         """Update discount code"""
-        try:
-            success = self.db.update_discount_code(code_id, **kwargs)
-            if success:
-                return True, "کد تخفیف با موفقیت بروزرسانی شد"
-            else:
-                return False, "خطا در بروزرسانی کد تخفیف"
-        except Exception as e:
-            logger.error(f"Error updating discount code: {e}")
-            return False, f"خطا در بروزرسانی کد تخفیف: {str(e)}"
+        success = self.db.update_discount_code(code_id, **kwargs)
+        if success:
+            return True, "کد تخفیف با موفقیت بروزرسانی شد"
+        else:
+            return False, "خطا در بروزرسانی کد تخفیف"
     
+    @_handle_db_errors("خطا در حذف کد تخفیف")
     def delete_discount_code(self, code_id: int) -> Tuple[bool, str]:
         """Delete discount code"""
-        try:
-            success = self.db.delete_discount_code(code_id)
-            if success:
-                return True, "کد تخفیف با موفقیت حذف شد"
-            else:
-                return False, "خطا در حذف کد تخفیف"
-        except Exception as e:
-            logger.error(f"Error deleting discount code: {e}")
-            return False, f"خطا در حذف کد تخفیف: {str(e)}"
+        success = self.db.delete_discount_code(code_id)
+        if success:
+            return True, "کد تخفیف با موفقیت حذف شد"
+        else:
+            return False, "خطا در حذف کد تخفیف"
     
     def get_all_discount_codes(self) -> list:
         """Get all discount codes"""
@@ -310,6 +649,14 @@ class DiscountCodeAdmin:
         """Get all gift codes"""
         return self.db.get_all_gift_codes(active_only=False)
     
+    def get_all_discount_codes_with_stats(self) -> list:
+        """Get all discount codes with usage statistics (avoids per-code stats queries)"""
+        return self.db.get_all_discount_codes_with_stats(active_only=False)
+    
+    def get_all_gift_codes_with_stats(self) -> list:
+        """Get all gift codes with usage statistics (avoids per-code stats queries)"""
+        return self.db.get_all_gift_codes_with_stats(active_only=False)
+    
     def get_discount_code_stats(self, code_id: int) -> Dict:
         """Get statistics for a discount code"""
         return self.db.get_discount_code_statistics(code_id)
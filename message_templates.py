@@ -4,17 +4,103 @@ Beautiful, consistent, and professional messages for the VPN bot
 Supports customizable texts via TextManager
 """
 
-from typing import Dict, List, Optional
+import logging
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Dict, List, Optional
 from username_formatter import UsernameFormatter
+from cache_utils import cache, cache_key_bot_text, cache_tag_bot_texts, invalidate_bot_text_cache
+from professional_database import ProfessionalDatabaseManager
+import sys
 import threading
+import time
+
+if TYPE_CHECKING:
+    from text_manager import TextManager
+
+logger = logging.getLogger(__name__)
+
+# Raw text templates are cached per (database_name, text_key) and formatted per call;
+# edits made through ProfessionalDatabaseManager invalidate them in-process, and the
+# TTL bounds staleness for edits made by another process (webapp vs. bot)
+TEXT_CACHE_TTL = 60
+
+# flask.g proxy, resolved on first use; False when Flask is not installed (bot-only deployments)
+_flask_g = None
+
+def _get_flask_g():
+    global _flask_g
+    if _flask_g is None:
+        try:
+            from flask import g
+        except ImportError:
+            g = False
+        _flask_g = g
+    return _flask_g
+
+# text_manager imports this module at load time, so TextManager is bound on first use
+_TextManager = None
+
+def _ensure_imports():
+    global _TextManager
+    if _TextManager is None:
+        from text_manager import TextManager
+        _TextManager = TextManager
+    return _TextManager
+
+# (database_name, text_key) -> interned text cache key. Reusing one key object per text
+# avoids building and hashing a new string per lookup, and lets the cache's dict hit
+# its identity fast path
+_text_cache_keys: Dict[tuple, str] = {}
+_TEXT_CACHE_KEYS_MAX_ENTRIES = 4096
+
+def _text_cache_key(database_name: str, text_key: str) -> str:
+    key = _text_cache_keys.get((database_name, text_key))
+    if key is None:
+        if len(_text_cache_keys) >= _TEXT_CACHE_KEYS_MAX_ENTRIES:
+            _text_cache_keys.clear()
+        key = sys.intern(cache_key_bot_text(database_name, text_key))
+        _text_cache_keys[(database_name, text_key)] = key
+    return key
+
+# Database name of the bot handling the current update. A context variable rather than
+# a thread-local: each python-telegram-bot update runs in its own asyncio task, so bots
+# sharing an event loop thread do not see each other's database name
+_current_database_name: ContextVar[Optional[str]] = ContextVar('message_templates_database_name', default=None)
+
+# (exception type, message) -> time it was last logged by _get_text
+_logged_lookup_errors: Dict[tuple, float] = {}
+_LOOKUP_ERROR_LOG_INTERVAL = 60
+_LOOKUP_ERROR_LOG_MAX_ENTRIES = 128
+
+def _should_log_lookup_error(error: Exception) -> bool:
+    """Rate-limit identical text lookup errors to one log record per interval"""
+    key = (type(error), str(error))
+    now = time.monotonic()
+    last_logged = _logged_lookup_errors.get(key)
+    if last_logged is not None and now - last_logged < _LOOKUP_ERROR_LOG_INTERVAL:
+        return False
+    if len(_logged_lookup_errors) >= _LOOKUP_ERROR_LOG_MAX_ENTRIES:
+        _logged_lookup_errors.clear()
+    _logged_lookup_errors[key] = now
+    return True
 
 class MessageTemplates:
     # Class-level TextManager instance (optional)
     _text_manager = None
     # Class-level database_name (for bot instances)
     _database_name = None
-    # Thread-local storage for bot-specific database names
-    _thread_local = threading.local()
+    # TextManager (and its ProfessionalDatabaseManager) per database_name, built once
+    _text_managers = {}
+    _text_managers_lock = threading.Lock()
+    
+    # Interned text keys of the fixed messages rendered by the format_* helpers
+    _KEY_WELCOME_ADMIN = sys.intern('welcome.admin')
+    _KEY_WELCOME_RETURNING_USER = sys.intern('welcome.returning_user')
+    _KEY_WELCOME_MAIN = sys.intern('welcome.main')
+    _KEY_SERVICE_PURCHASE_SUCCESS = sys.intern('service.purchase_success')
+    _KEY_SERVICE_RENEWAL_SUCCESS = sys.intern('service.renewal_success')
+    _KEY_INFO_BALANCE_INFO = sys.intern('info.balance_info')
+    _KEY_INFO_SERVICE_INFO = sys.intern('info.service_info')
     
     @classmethod
     def set_text_manager(cls, text_manager):
@@ -23,100 +109,166 @@ class MessageTemplates:
         # Also store database_name from the TextManager's db instance
         if text_manager and hasattr(text_manager, 'db') and hasattr(text_manager.db, 'database_name'):
             cls._database_name = text_manager.db.database_name
-            # Store in thread-local storage for this bot instance
-            cls._thread_local.database_name = text_manager.db.database_name
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.info(f"✅ MessageTemplates: Set database_name to '{cls._database_name}' from TextManager (thread-local: {getattr(cls._thread_local, 'database_name', None)})")
+            # Store in the current context for this bot instance
+            _current_database_name.set(text_manager.db.database_name)
+            # Reuse it for _get_text lookups on this database instead of building another
+            with cls._text_managers_lock:
+                cls._text_managers.setdefault(cls._database_name, text_manager)
+            logger.info("✅ MessageTemplates: Set database_name to '%s' from TextManager (context: %s)",
+                        cls._database_name, _current_database_name.get())
     
     @classmethod
     def set_database_name(cls, database_name: str):
-        """Set database name for current thread (bot instance)"""
-        cls._thread_local.database_name = database_name
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.debug(f"🔍 MessageTemplates: Set thread-local database_name to '{database_name}'")
+        """Set database name for the current context (bot instance handling this update)"""
+        _current_database_name.set(database_name)
+        logger.debug("🔍 MessageTemplates: Set context database_name to '%s'", database_name)
+    
+    @classmethod
+    def invalidate_text_cache(cls, db_name: str = None):
+        """Drop cached texts of one database, or of every database seen so far"""
+        if db_name:
+            invalidate_bot_text_cache(db_name)
+            return
+        with cls._text_managers_lock:
+            text_managers = list(cls._text_managers.values())
+        for text_manager in text_managers:
+            invalidate_bot_text_cache(text_manager.db.database_name)
+    
+    @classmethod
+    def prime_text_cache(cls, db_name: str = None) -> int:
+        """
+        Load all texts of a database into the text cache with one query
+        
+        Known text keys without an active customized text are cached as missing,
+        so the first render of each message does not hit the database either.
+        Returns the number of customized texts loaded. If the query fails the
+        error propagates and nothing is cached, so a DB outage at startup is not
+        mistaken for "no customized texts".
+        """
+        text_manager = cls._get_text_manager(db_name)
+        database_name = text_manager.db.database_name
+        tag = cache_tag_bot_texts(database_name)
+        
+        customized = {
+            row['text_key']: row['text_content']
+            for row in text_manager.db.get_all_bot_texts(raise_errors=True)
+            if row.get('text_content')
+        }
+        for text_key in text_manager.TEXT_DEFINITIONS.keys() | customized.keys():
+            cache.set_with_tag(_text_cache_key(database_name, text_key),
+                               customized.get(text_key, ''), tag, ttl=TEXT_CACHE_TTL)
+        return len(customized)
+    
+    @classmethod
+    def _get_text_manager(cls, db_name: Optional[str]) -> 'TextManager':
+        """Get the shared TextManager for a database, creating it on first use"""
+        text_manager = cls._text_managers.get(db_name)
+        if text_manager is None:
+            with cls._text_managers_lock:
+                text_manager = cls._text_managers.get(db_name)
+                if text_manager is None:
+                    text_manager = _ensure_imports()(ProfessionalDatabaseManager.for_database(db_name))
+                    cls._text_managers[db_name] = text_manager
+        return text_manager
     
     @classmethod
     def _get_text(cls, text_key: str, variables: Dict = None) -> str:
         """Get text from TextManager if available, otherwise use default"""
-        import logging
-        logger = logging.getLogger(__name__)
+        # An unbound flask.g proxy is falsy, so g is only truthy inside an app context
+        g = _get_flask_g()
+        
+        # Fast path: no bot has configured texts in this process and this is not a
+        # webapp request, so the caller's built-in default is used without any lookup
+        if (cls._text_manager is None and cls._database_name is None
+                and _current_database_name.get() is None and not g):
+            return None
         
-        # Always try to get from database first - create TextManager on the fly if needed
+        # Always try to get from database first - through the shared TextManager for that database
         text_content = None
+        lookup_failed = False
         
         try:
-            # Try to get database and TextManager
-            from professional_database import ProfessionalDatabaseManager
-            from config import MYSQL_CONFIG
-            from text_manager import TextManager
-            
             # Priority 1: Try to get database_name from Flask request context (webapp)
             db_name = None
-            try:
-                from flask import g
-                if hasattr(g, 'bot_config') and g.bot_config:
-                    db_name = g.bot_config.get('database_name')
-                    if db_name:
-                        logger.debug(f"🔍 MessageTemplates: Got database_name '{db_name}' from Flask g.bot_config")
-            except:
-                pass
-            
-            # Priority 2: Use thread-local database_name (set by current bot instance)
-            if not db_name:
+            if g:
                 try:
-                    db_name = getattr(cls._thread_local, 'database_name', None)
-                    if db_name:
-                        logger.debug(f"🔍 MessageTemplates: Using thread-local database_name '{db_name}'")
-                except:
+                    bot_config = g.get('bot_config')
+                    if bot_config:
+                        db_name = bot_config.get('database_name')
+                        if db_name:
+                            logger.debug("🔍 MessageTemplates: Got database_name '%s' from Flask g.bot_config", db_name)
+                except RuntimeError:
+                    # Outside of an application context (bot process)
                     pass
             
+            # Priority 2: Use context database_name (set by current bot instance)
+            if not db_name:
+                db_name = _current_database_name.get()
+                if db_name:
+                    logger.debug("🔍 MessageTemplates: Using context database_name '%s'", db_name)
+            
             # Priority 3: Use class-level database_name (fallback, but may be wrong in multi-bot)
             if not db_name and cls._database_name:
                 db_name = cls._database_name
-                logger.warning(f"⚠️ MessageTemplates: Using class-level database_name '{db_name}' (may be incorrect in multi-bot mode)")
-            
-            # Create database instance with correct database_name
-            if db_name:
-                mysql_config = MYSQL_CONFIG.copy()
-                mysql_config['database'] = db_name
-                db = ProfessionalDatabaseManager(db_config=mysql_config)
-                logger.debug(f"🔍 MessageTemplates: Created DB instance for database '{db_name}'")
-            else:
-                db = ProfessionalDatabaseManager(db_config=MYSQL_CONFIG)
-                logger.warning(f"⚠️ MessageTemplates: No database_name found, using default database '{db.database_name}'")
+                logger.warning("⚠️ MessageTemplates: Using class-level database_name '%s' (may be incorrect in multi-bot mode)", db_name)
             
-            # Create a fresh TextManager instance (no cache, always reads from DB)
-            text_manager = TextManager(db)
+            text_manager = cls._get_text_manager(db_name)
+            if not db_name:
+                logger.warning("⚠️ MessageTemplates: No database_name found, using default database '%s'", text_manager.db.database_name)
             
-            # Get text directly from database
-            text_content = text_manager.get_text(text_key, variables, use_default_if_missing=False)
+            # Raw template from cache or database; variables are substituted per call
+            database_name = text_manager.db.database_name
+            key = _text_cache_key(database_name, text_key)
+            text_content = cache.get(key)
+            if text_content is None:
+                # '' marks a text that is not customized, so defaults are served without a
+                # query; a failed query raises instead, so an outage is never cached as ''
+                db_text = text_manager.db.get_bot_text(text_key, raise_errors=True)
+                text_content = (db_text.get('text_content') if db_text else None) or ''
+                cache.set_with_tag(key, text_content, cache_tag_bot_texts(database_name), ttl=TEXT_CACHE_TTL)
             
             if text_content:
-                logger.info(f"✅ Loaded text '{text_key}' from database '{db.database_name}' (length: {len(text_content)})")
+                if variables:
+                    text_content = text_manager.format_text_with_variables(text_content, variables)
+                logger.info("✅ Loaded text '%s' from database '%s' (length: %d)", text_key, database_name, len(text_content))
                 return text_content
             else:
-                logger.debug(f"ℹ️ Text '{text_key}' not found in database '{db.database_name}', will use default")
+                logger.debug("ℹ️ Text '%s' not found in database '%s', will use default", text_key, database_name)
                 
         except Exception as e:
-            logger.warning(f"⚠️ Error getting text '{text_key}' from database: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
+            # During a DB outage every render fails the same way; log each distinct error
+            # once per interval, with the traceback only when debugging
+            if _should_log_lookup_error(e):
+                logger.warning("⚠️ Error getting text '%s' from database: %s", text_key, e,
+                               exc_info=logger.isEnabledFor(logging.DEBUG))
+            lookup_failed = True
         
-        # Priority 3: If we have a class-level TextManager, use it directly (it's already configured with correct database)
-        if not text_content and cls._text_manager:
+        # Priority 3: If the lookup above failed and we have a class-level TextManager, use it
+        # directly (it's already configured with correct database). A text that is simply not
+        # customized goes straight to the caller's default without another query.
+        if lookup_failed and cls._text_manager:
             try:
-                text_content = cls._text_manager.get_text(text_key, variables, use_default_if_missing=True)
+                # Same raising read as above, so an outage is logged through the rate limit below
+                # rather than with a traceback per render
+                text_manager = cls._text_manager
+                db_text = text_manager.db.get_bot_text(text_key, raise_errors=True) if text_manager.db else None
+                text_content = db_text.get('text_content') if db_text else None
+                if not text_content:
+                    text_def = text_manager.TEXT_DEFINITIONS.get(text_key)
+                    text_content = text_def['default'] if text_def else None
                 if text_content:
-                    db_name_used = getattr(cls._text_manager.db, 'database_name', 'unknown') if hasattr(cls._text_manager, 'db') else 'unknown'
-                    logger.info(f"✅ Got text '{text_key}' from class TextManager (database: '{db_name_used}', length: {len(text_content)})")
+                    if variables:
+                        text_content = text_manager.format_text_with_variables(text_content, variables)
+                    db_name_used = getattr(text_manager.db, 'database_name', 'unknown')
+                    logger.info("✅ Got text '%s' from class TextManager (database: '%s', length: %d)", text_key, db_name_used, len(text_content))
                     return text_content
             except Exception as e:
-                logger.warning(f"⚠️ Error getting text from class TextManager: {e}")
+                if _should_log_lookup_error(e):
+                    logger.warning("⚠️ Error getting text '%s' from class TextManager: %s", text_key, e,
+                                   exc_info=logger.isEnabledFor(logging.DEBUG))
         
         # Fallback to default
-        logger.debug(f"ℹ️ Using default text for '{text_key}'")
+        logger.debug("ℹ️ Using default text for '%s'", text_key)
         return None
     """Professional message templates with consistent styling"""
     
@@ -507,18 +659,15 @@ class MessageTemplates:
     @staticmethod
     def format_welcome_message(user_data: Dict, is_admin: bool = False, bot_name: str = "AzadJooNet") -> str:
         """Format welcome message based on user data"""
-        import logging
-        logger = logging.getLogger(__name__)
-        
         variables = {'bot_name': bot_name}
         
         if is_admin:
-            text = MessageTemplates._get_text('welcome.admin', variables)
+            text = MessageTemplates._get_text(MessageTemplates._KEY_WELCOME_ADMIN, variables)
             if text:
                 logger.info("✅ Using customized text for 'welcome.admin'")
                 return text
             logger.info("📝 Using default text for 'welcome.admin'")
-            return MessageTemplates.WELCOME_MESSAGES['admin'].format(**variables)
+            return MessageTemplates.WELCOME_MESSAGES['admin'].format_map(variables)
         
         # Handle None user_data
         if user_data is None:
@@ -531,19 +680,19 @@ class MessageTemplates:
                 'balance': UsernameFormatter.format_balance(user_data.get('balance', 0)),
                 'last_activity': user_data.get('last_activity', 'نامشخص')
             })
-            text = MessageTemplates._get_text('welcome.returning_user', variables)
+            text = MessageTemplates._get_text(MessageTemplates._KEY_WELCOME_RETURNING_USER, variables)
             if text:
                 logger.info("✅ Using customized text for 'welcome.returning_user'")
                 return text
             logger.info("📝 Using default text for 'welcome.returning_user'")
-            return MessageTemplates.WELCOME_MESSAGES['returning_user'].format(**variables)
+            return MessageTemplates.WELCOME_MESSAGES['returning_user'].format_map(variables)
         
-        text = MessageTemplates._get_text('welcome.main', variables)
+        text = MessageTemplates._get_text(MessageTemplates._KEY_WELCOME_MAIN, variables)
         if text:
             logger.info("✅ Using customized text for 'welcome.main'")
             return text
         logger.info("📝 Using default text for 'welcome.main'")
-        return MessageTemplates.WELCOME_MESSAGES['main'].format(**variables)
+        return MessageTemplates.WELCOME_MESSAGES['main'].format_map(variables)
     
     @staticmethod
     def format_service_success_message(service_data: Dict, payment_data: Dict) -> str:
@@ -554,10 +703,10 @@ class MessageTemplates:
             'amount': payment_data.get('amount', 0),
             'purchase_date': service_data.get('created_at', 'نامشخص')
         }
-        text = MessageTemplates._get_text('service.purchase_success', variables)
+        text = MessageTemplates._get_text(MessageTemplates._KEY_SERVICE_PURCHASE_SUCCESS, variables)
         if text:
             return text
-        return MessageTemplates.SERVICE_MESSAGES['purchase_success'].format(**variables)
+        return MessageTemplates.SERVICE_MESSAGES['purchase_success'].format_map(variables)
     
     @staticmethod
     def format_renewal_success_message(renewal_data: Dict) -> str:
@@ -568,41 +717,42 @@ class MessageTemplates:
             'total_data': renewal_data.get('total_data', 0),
             'amount': renewal_data.get('amount', 0)
         }
-        text = MessageTemplates._get_text('service.renewal_success', variables)
+        text = MessageTemplates._get_text(MessageTemplates._KEY_SERVICE_RENEWAL_SUCCESS, variables)
         if text:
             return text
-        return MessageTemplates.SERVICE_MESSAGES['renewal_success'].format(**variables)
+        return MessageTemplates.SERVICE_MESSAGES['renewal_success'].format_map(variables)
     
     @staticmethod
     def format_error_message(error_type: str, **kwargs) -> str:
         """Format error message"""
-        text_key = f'error.{error_type}'
+        text_key = MessageTemplates._ERROR_KEY_BY_TYPE.get(error_type) or f'error.{error_type}'
         text = MessageTemplates._get_text(text_key, kwargs)
         if text:
             return text
-        template = MessageTemplates.ERROR_MESSAGES.get(error_type, MessageTemplates.ERROR_MESSAGES['general_error'])
-        return template.format(**kwargs)
+        template = MessageTemplates.ERROR_MESSAGES.get(error_type, MessageTemplates._DEFAULT_ERROR_TEMPLATE)
+        return template.format_map(kwargs)
     
     @staticmethod
     def format_success_message(success_type: str, **kwargs) -> str:
         """Format success message"""
-        text_key = f'success.{success_type}'
+        text_key = MessageTemplates._SUCCESS_KEY_BY_TYPE.get(success_type) or f'success.{success_type}'
         text = MessageTemplates._get_text(text_key, kwargs)
         if text:
             return text
-        template = MessageTemplates.SUCCESS_MESSAGES.get(success_type, MessageTemplates.SUCCESS_MESSAGES['operation_success'])
-        return template.format(**kwargs)
+        template = MessageTemplates.SUCCESS_MESSAGES.get(success_type, MessageTemplates._DEFAULT_SUCCESS_TEMPLATE)
+        return template.format_map(kwargs)
     
     @staticmethod
     def format_notification_message(notification_type: str, **kwargs) -> str:
         """Format notification message"""
-        text_key = f'notification.{notification_type}'
+        text_key = (MessageTemplates._NOTIFICATION_KEY_BY_TYPE.get(notification_type)
+                    or f'notification.{notification_type}')
         text = MessageTemplates._get_text(text_key, kwargs)
         if text:
             return text
         template = MessageTemplates.NOTIFICATION_MESSAGES.get(notification_type)
         if template:
-            return template.format(**kwargs)
+            return template.format_map(kwargs)
         return "🔔 اعلان جدید"
     
     @staticmethod
@@ -625,10 +775,10 @@ class MessageTemplates:
             'failed_payments': 0,      # TODO: Add to database
             'total_transactions': 0    # TODO: Add to database
         }
-        text = MessageTemplates._get_text('info.balance_info', variables)
+        text = MessageTemplates._get_text(MessageTemplates._KEY_INFO_BALANCE_INFO, variables)
         if text:
             return text
-        return MessageTemplates.INFO_MESSAGES['balance_info'].format(**variables)
+        return MessageTemplates.INFO_MESSAGES['balance_info'].format_map(variables)
     
     @staticmethod
     def format_service_details_message(service_data: Dict) -> str:
@@ -652,8 +802,26 @@ class MessageTemplates:
             'speed': service_data.get('speed', 'نامشخص'),
             'ping': service_data.get('ping', 'نامشخص')
         }
-        text = MessageTemplates._get_text('info.service_info', variables)
+        text = MessageTemplates._get_text(MessageTemplates._KEY_INFO_SERVICE_INFO, variables)
         if text:
             return text
-        return MessageTemplates.INFO_MESSAGES['service_info'].format(**variables)
-
+        return MessageTemplates.INFO_MESSAGES['service_info'].format_map(variables)
+
+
+# Templates are written as indented triple-quoted blocks; strip the surrounding
+# newlines/indentation once here instead of shipping (or re-stripping) them per message
+for _templates in (MessageTemplates.WELCOME_MESSAGES, MessageTemplates.SERVICE_MESSAGES,
+                   MessageTemplates.PAYMENT_MESSAGES, MessageTemplates.ERROR_MESSAGES,
+                   MessageTemplates.SUCCESS_MESSAGES, MessageTemplates.INFO_MESSAGES,
+                   MessageTemplates.NOTIFICATION_MESSAGES):
+    for _key, _template in _templates.items():
+        _templates[_key] = _template.strip()
+del _templates, _key, _template
+
+# Text keys of the built-in message types, so the format_* helpers do not rebuild
+# them per call; unknown types still fall back to building the key
+MessageTemplates._ERROR_KEY_BY_TYPE = {k: sys.intern(f'error.{k}') for k in MessageTemplates.ERROR_MESSAGES}
+MessageTemplates._SUCCESS_KEY_BY_TYPE = {k: sys.intern(f'success.{k}') for k in MessageTemplates.SUCCESS_MESSAGES}
+MessageTemplates._NOTIFICATION_KEY_BY_TYPE = {k: sys.intern(f'notification.{k}') for k in MessageTemplates.NOTIFICATION_MESSAGES}
+MessageTemplates._DEFAULT_ERROR_TEMPLATE = MessageTemplates.ERROR_MESSAGES['general_error']
+MessageTemplates._DEFAULT_SUCCESS_TEMPLATE = MessageTemplates.SUCCESS_MESSAGES['operation_success']
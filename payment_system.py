@@ -4,26 +4,63 @@ Handles payment management (Gateway removed)
 """
 
 import logging
+import threading
+import weakref
 from typing import Dict, Any, Optional
 
 logger = logging.getLogger(__name__)
 
+try:
+    from discount_manager import DiscountCodeManager
+except ImportError:
+    DiscountCodeManager = None
+
+# DiscountCodeManager shared by all PaymentManagers of one database manager. Keyed by
+# id(): each manager holds its database manager, so the id cannot be reused while the
+# entry is alive, and the entry goes away with the last PaymentManager using it
+_discount_managers = weakref.WeakValueDictionary()
+_discount_managers_lock = threading.Lock()
+
+def _get_discount_manager(database_manager):
+    """Get the shared DiscountCodeManager for a database manager, or None if unavailable"""
+    if DiscountCodeManager is None:
+        return None
+    with _discount_managers_lock:
+        discount_manager = _discount_managers.get(id(database_manager))
+        if discount_manager is None:
+            discount_manager = DiscountCodeManager(database_manager)
+            _discount_managers[id(database_manager)] = discount_manager
+        return discount_manager
+
 # StarsefarAPI class removed as per request
 
+GATEWAY_DISABLED_MESSAGE = 'درگاه پرداخت غیرفعال است'
+
+def _gateway_disabled_result() -> Dict[str, Any]:
+    """Result returned by every gateway placeholder while no gateway is configured"""
+    return {'success': False, 'message': GATEWAY_DISABLED_MESSAGE}
+
 class PaymentManager:
     """Manages payment operations and invoices"""
     
+    # Balance transaction description and type per invoice purchase_type
+    _DESC_BY_PURCHASE_TYPE = {
+        'plan': 'خرید اشتراک پلنی',
+        'gigabyte': 'خرید سرویس گیگابایتی',
+    }
+    _DEFAULT_PURCHASE_DESC = _DESC_BY_PURCHASE_TYPE['gigabyte']
+    _TXN_TYPE_BY_PURCHASE_TYPE = {
+        'plan': 'service_purchase',
+        'gigabyte': 'service_purchase',
+    }
+    
     def __init__(self, database_manager, starsefar_api=None):
         self.db = database_manager
         # starsefar_api is ignored/removed
         self.starsefar = None
-        # Import discount manager
-        try:
-            from discount_manager import DiscountCodeManager
-            self.discount_manager = DiscountCodeManager(database_manager)
-        except ImportError:
+        self.discount_manager = _get_discount_manager(database_manager)
+        if self.discount_manager is None:
             logger.warning("Discount manager not available")
-            self.discount_manager = None
     
     def get_user_balance(self, user_id: int) -> int:
         """Get user's current balance"""
@@ -53,34 +90,24 @@ class PaymentManager:
                     discount_code_id = discount_result['code_id']
                 else:
                     # Discount code invalid, but continue without discount
-                    logger.warning(f"Invalid discount code: {discount_result.get('message')}")
+                    logger.warning("Invalid discount code: %s", discount_result.get('message'))
             
-            # Create invoice in database
+            # Create invoice in database, including discount info if a discount was applied
             invoice_id = self.db.add_invoice(
                 user_id=user['id'],
                 panel_id=panel_id,
                 gb_amount=gb_amount,
                 amount=amount,
                 payment_method=payment_method,
-                status='pending'
+                status='pending',
+                discount_code_id=discount_code_id,
+                discount_amount=discount_amount if discount_code_id else None,
+                original_amount=original_amount if discount_code_id else None
             )
             
             if not invoice_id:
                 return {'success': False, 'message': 'Failed to create invoice'}
             
-            # Update invoice with discount info if discount was applied
-            if discount_code_id:
-                with self.db.get_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        UPDATE invoices 
-                        SET discount_code_id = ?, 
-                            discount_amount = ?,
-                            original_amount = ?
-                        WHERE id = ?
-                    ''', (discount_code_id, discount_amount, original_amount, invoice_id))
-                    conn.commit()
-            
             return {
                 'success': True,
                 'invoice_id': invoice_id,
@@ -91,14 +118,14 @@ class PaymentManager:
             }
             
         except Exception as e:
-            logger.error(f"Error creating invoice: {e}")
+            logger.error("Error creating invoice: %s", e)
             return {'success': False, 'message': str(e)}
     
     def process_balance_payment(self, user_id: int, invoice_id: int) -> Dict[str, Any]:
         """Process payment using user's balance"""
         try:
-            # Get invoice
-            invoice = self.db.get_invoice(invoice_id)
+            # Get invoice and the paying user in one round-trip
+            invoice = self.db.get_invoice_with_payer(invoice_id, user_id)
             if not invoice:
                 return {'success': False, 'message': 'Invoice not found'}
             
@@ -106,56 +133,45 @@ class PaymentManager:
             if invoice['status'] == 'paid':
                 return {'success': False, 'message': 'Invoice already paid'}
             
-            # Get user
-            user = self.db.get_user(user_id)
-            if not user:
+            if invoice['payer_id'] is None:
                 return {'success': False, 'message': 'User not found'}
             
             # Use discounted amount if available
             payment_amount = invoice.get('amount', invoice.get('original_amount', 0))
             
             # Check balance
-            if user['balance'] < payment_amount:
+            if invoice['payer_balance'] < payment_amount:
                 return {'success': False, 'message': 'Insufficient balance'}
             
-            # Record discount usage if discount was applied
+            # Discount usage to record along with the payment, if a discount was applied
+            discount_usage = None
             if invoice.get('discount_code_id') and self.discount_manager:
                 discount_amount = invoice.get('discount_amount', 0)
-                original_amount = invoice.get('original_amount', payment_amount + discount_amount)
-                self.db.apply_discount_code(
-                    code_id=invoice['discount_code_id'],
-                    user_id=user['id'],
-                    invoice_id=invoice_id,
-                    amount_before=original_amount,
-                    discount_amount=discount_amount,
-                    amount_after=payment_amount
-                )
-            
-            # Update invoice status to paid
-            if not self.db.update_invoice_status(invoice_id, 'paid'):
-                return {'success': False, 'message': 'Failed to update invoice'}
-            
-            # Deduct balance
-            # Create Persian description based on purchase type
+                discount_usage = {
+                    'code_id': invoice['discount_code_id'],
+                    'amount_before': invoice.get('original_amount', payment_amount + discount_amount),
+                    'discount_amount': discount_amount,
+                    'amount_after': payment_amount
+                }
+            
+            # Persian description based on purchase type; plan purchases name the plan
+            # (joined with the invoice) when it is known
             purchase_type = invoice.get('purchase_type', 'gigabyte')
-            product_id = invoice.get('product_id')
-            
-            if purchase_type == 'plan' and product_id:
-                # Plan-based purchase
-                product = self.db.get_product(product_id)
-                product_name = product.get('name', '') if product else ''
-                if product_name:
-                    description = f'خرید اشتراک پلنی: {product_name}'
-                else:
-                    description = f'خرید اشتراک پلنی'
-                transaction_type = 'service_purchase'
-            else:
-                # Gigabyte-based purchase
-                description = f'خرید سرویس گیگابایتی'
-                transaction_type = 'service_purchase'
-            
-            if not self.db.update_user_balance(user_id, -payment_amount, transaction_type, description):
-                return {'success': False, 'message': 'Failed to deduct balance'}
+            if purchase_type == 'plan' and not invoice.get('product_id'):
+                purchase_type = 'gigabyte'
+            description = self._DESC_BY_PURCHASE_TYPE.get(purchase_type, self._DEFAULT_PURCHASE_DESC)
+            transaction_type = self._TXN_TYPE_BY_PURCHASE_TYPE.get(purchase_type, 'service_purchase')
+            product_name = invoice.get('product_name') if purchase_type == 'plan' else None
+            if product_name:
+                description = f'{description}: {product_name}'
+            
+            # Re-check status and balance under row locks, then record the discount,
+            # mark the invoice paid and deduct the balance in a single transaction
+            paid, error_message = self.db.pay_invoice_with_balance(
+                invoice_id, user_id, payment_amount, transaction_type, description, discount_usage
+            )
+            if not paid:
+                return {'success': False, 'message': error_message or 'Failed to deduct balance'}
             
             return {
                 'success': True,
@@ -165,31 +181,31 @@ class PaymentManager:
             }
             
         except Exception as e:
-            logger.error(f"Error processing balance payment: {e}")
+            logger.error("Error processing balance payment: %s", e)
             return {'success': False, 'message': str(e)}
     
     def process_gateway_payment(self, user_id: int, invoice_id: int) -> Dict[str, Any]:
         """Process payment through gateway (Placeholder)"""
         # Placeholder for future payment gateway
-        return {'success': False, 'message': 'درگاه پرداخت غیرفعال است'}
+        return _gateway_disabled_result()
     
     def create_balance_payment(self, user_id: int, amount: int) -> Dict[str, Any]:
         """Create a balance top-up payment (Placeholder)"""
         # Placeholder for future payment gateway
-        return {'success': False, 'message': 'درگاه پرداخت غیرفعال است'}
+        return _gateway_disabled_result()
     
     def create_service_payment(self, user_id: int, panel_id: int, volume_gb: int, price: int, 
                              invoice_id: int = None, discount_code: str = None) -> Dict[str, Any]:
         """Create a new service purchase payment (Placeholder)"""
         # Placeholder for future payment gateway
-        return {'success': False, 'message': 'درگاه پرداخت غیرفعال است'}
+        return _gateway_disabled_result()
     
     def create_volume_payment(self, user_id: int, panel_id: int, volume_gb: int, price: int, discount_code: str = None) -> Dict[str, Any]:
         """Create a volume purchase payment (Placeholder)"""
         # Placeholder for future payment gateway
-        return {'success': False, 'message': 'درگاه پرداخت غیرفعال است'}
+        return _gateway_disabled_result()
     
     def create_add_volume_payment(self, user_id: int, service_id: int, panel_id: int, volume_gb: int, price: int, discount_code: str = None) -> Dict[str, Any]:
         """Create a payment for adding volume to existing service (Placeholder)"""
         # Placeholder for future payment gateway
-        return {'success': False, 'message': 'درگاه پرداخت غیرفعال است'}
+        return _gateway_disabled_result()
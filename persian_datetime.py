@@ -4,12 +4,87 @@ Provides functions for working with Persian (Jalali) calendar and Tehran timezon
 """
 
 import jdatetime
-import pytz
-from datetime import datetime
-from typing import Optional
+import re
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Optional, Tuple
+from zoneinfo import ZoneInfo
 
 # Tehran timezone
-TEHRAN_TZ = pytz.timezone('Asia/Tehran')
+TEHRAN_TZ = ZoneInfo('Asia/Tehran')
+_UTC = timezone.utc
+
+# Persian month names, indexed by Jalali month number (1-12)
+_PERSIAN_MONTHS = (
+    '',
+    'فروردین',
+    'اردیبهشت',
+    'خرداد',
+    'تیر',
+    'مرداد',
+    'شهریور',
+    'مهر',
+    'آبان',
+    'آذر',
+    'دی',
+    'بهمن',
+    'اسفند',
+)
+
+# Persian weekday names, Saturday (start of the Persian week) first
+_PERSIAN_WEEKDAYS = (
+    'شنبه',
+    'یکشنبه',
+    'دوشنبه',
+    'سه‌شنبه',
+    'چهارشنبه',
+    'پنج‌شنبه',
+    'جمعه',
+)
+
+# The same names indexed by Python's weekday() (Monday is 0), so no remapping per call
+_PERSIAN_WEEKDAYS_BY_PY_WEEKDAY = tuple(_PERSIAN_WEEKDAYS[(weekday + 2) % 7] for weekday in range(7))
+
+# Datetime formats accepted by parse_datetime, in the order they are tried
+_PARSE_FORMATS = (
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y/%m/%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S.%fZ',
+    '%Y-%m-%dT%H:%M:%SZ',
+)
+
+# Zero-padded forms of _PARSE_FORMATS in one pass; parse_datetime rejects the
+# separator combinations none of those formats allow
+_DATETIME_PATTERN = re.compile(
+    r'([0-9]{4})([-/])([0-9]{2})\2([0-9]{2})([ T])([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.([0-9]{1,6}))?(Z?)'
+)
+
+# Cumulative day count before each Gregorian month in a non-leap year
+_GREGORIAN_DAYS_BEFORE_MONTH = (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+
+def _greg_to_jalali(gy: int, gm: int, gd: int) -> Tuple[int, int, int]:
+    """
+    Convert a Gregorian date to a Jalali (year, month, day) with integer arithmetic
+    
+    Rendering only needs the date parts, so this skips building a jdatetime object.
+    """
+    gy2 = gy + 1 if gm > 2 else gy
+    days = (355666 + 365 * gy + (gy2 + 3) // 4 - (gy2 + 99) // 100 + (gy2 + 399) // 400
+            + gd + _GREGORIAN_DAYS_BEFORE_MONTH[gm - 1])
+    jy = -1595 + 33 * (days // 12053)
+    days %= 12053
+    jy += 4 * (days // 1461)
+    days %= 1461
+    if days > 365:
+        jy += (days - 1) // 365
+        days = (days - 1) % 365
+    if days < 186:
+        return jy, 1 + days // 31, 1 + days % 31
+    return jy, 7 + (days - 186) // 30, 1 + (days - 186) % 30
 
 class PersianDateTime:
     """Helper class for Persian datetime operations"""
@@ -17,15 +92,13 @@ class PersianDateTime:
     @staticmethod
     def now() -> jdatetime.datetime:
         """Get current datetime in Tehran timezone as Jalali"""
-        utc_now = datetime.now(pytz.UTC)
-        tehran_now = utc_now.astimezone(TEHRAN_TZ)
-        return jdatetime.datetime.fromgregorian(datetime=tehran_now)
+        return jdatetime.datetime.fromgregorian(datetime=datetime.now(TEHRAN_TZ))
     
     @staticmethod
     def now_gregorian() -> datetime:
         """Get current datetime in Tehran timezone as Gregorian"""
-        utc_now = datetime.now(pytz.UTC)
-        return utc_now.astimezone(TEHRAN_TZ)
+        # datetime.now(tz) converts through tz.fromutc directly, without a UTC-aware hop
+        return datetime.now(TEHRAN_TZ)
     
     @staticmethod
     def format_datetime(dt: Optional[datetime] = None, include_time: bool = True) -> str:
@@ -40,21 +113,22 @@ class PersianDateTime:
             Formatted Persian datetime string
         """
         if dt is None:
-            jalali_dt = PersianDateTime.now()
+            dt = PersianDateTime.now_gregorian()
         else:
-            # Convert to Tehran timezone if it has timezone info
+            # Convert to Tehran timezone if it has timezone info; datetimes from
+            # now_gregorian() are already in it
             if dt.tzinfo is not None:
-                dt = dt.astimezone(TEHRAN_TZ)
+                if dt.tzinfo is not TEHRAN_TZ:
+                    dt = dt.astimezone(TEHRAN_TZ)
             else:
                 # Assume it's UTC and convert
-                dt = pytz.UTC.localize(dt).astimezone(TEHRAN_TZ)
-            
-            jalali_dt = jdatetime.datetime.fromgregorian(datetime=dt)
+                dt = dt.replace(tzinfo=_UTC).astimezone(TEHRAN_TZ)
         
+        jy, jm, jd = _greg_to_jalali(dt.year, dt.month, dt.day)
         if include_time:
-            return jalali_dt.strftime('%Y/%m/%d %H:%M:%S')
+            return f"{jy}/{jm:02d}/{jd:02d} {dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
         else:
-            return jalali_dt.strftime('%Y/%m/%d')
+            return f"{jy}/{jm:02d}/{jd:02d}"
     
     @staticmethod
     def format_date_persian(dt: Optional[datetime] = None) -> str:
@@ -68,42 +142,29 @@ class PersianDateTime:
             Formatted Persian date string with month name
         """
         if dt is None:
-            jalali_dt = PersianDateTime.now()
+            dt = PersianDateTime.now_gregorian()
         else:
-            # Convert to Tehran timezone if it has timezone info
+            # Convert to Tehran timezone if it has timezone info; datetimes from
+            # now_gregorian() are already in it
             if dt.tzinfo is not None:
-                dt = dt.astimezone(TEHRAN_TZ)
+                if dt.tzinfo is not TEHRAN_TZ:
+                    dt = dt.astimezone(TEHRAN_TZ)
             else:
                 # Assume it's UTC and convert
-                dt = pytz.UTC.localize(dt).astimezone(TEHRAN_TZ)
-            
-            jalali_dt = jdatetime.datetime.fromgregorian(datetime=dt)
-        
-        # Persian month names
-        month_names = {
-            1: 'فروردین',
-            2: 'اردیبهشت',
-            3: 'خرداد',
-            4: 'تیر',
-            5: 'مرداد',
-            6: 'شهریور',
-            7: 'مهر',
-            8: 'آبان',
-            9: 'آذر',
-            10: 'دی',
-            11: 'بهمن',
-            12: 'اسفند'
-        }
+                dt = dt.replace(tzinfo=_UTC).astimezone(TEHRAN_TZ)
         
-        return f"{jalali_dt.day} {month_names[jalali_dt.month]} {jalali_dt.year}"
+        jy, jm, jd = _greg_to_jalali(dt.year, dt.month, dt.day)
+        return f"{jd} {_PERSIAN_MONTHS[jm]} {jy}"
     
     @staticmethod
-    def format_time(dt: Optional[datetime] = None) -> str:
+    def format_time(dt: Optional[datetime] = None, assume_tehran: bool = False) -> str:
         """
         Format time only
         
         Args:
             dt: datetime object (if None, uses current time)
+            assume_tehran: treat a naive dt as Tehran wall-clock time instead of UTC
+                (for values stored in Tehran local time), skipping any conversion
             
         Returns:
             Formatted time string
@@ -111,14 +172,19 @@ class PersianDateTime:
         if dt is None:
             tehran_dt = PersianDateTime.now_gregorian()
         else:
-            # Convert to Tehran timezone if it has timezone info
-            if dt.tzinfo is not None:
+            # Convert to Tehran timezone if it has timezone info; datetimes from
+            # now_gregorian() are already in it
+            if dt.tzinfo is TEHRAN_TZ:
+                tehran_dt = dt
+            elif dt.tzinfo is not None:
                 tehran_dt = dt.astimezone(TEHRAN_TZ)
+            elif assume_tehran:
+                tehran_dt = dt
             else:
                 # Assume it's UTC and convert
-                tehran_dt = pytz.UTC.localize(dt).astimezone(TEHRAN_TZ)
+                tehran_dt = dt.replace(tzinfo=_UTC).astimezone(TEHRAN_TZ)
         
-        return tehran_dt.strftime('%H:%M:%S')
+        return f"{tehran_dt.hour:02d}:{tehran_dt.minute:02d}:{tehran_dt.second:02d}"
     
     @staticmethod
     def parse_datetime(datetime_str: str) -> Optional[datetime]:
@@ -134,18 +200,20 @@ class PersianDateTime:
         try:
             if not datetime_str:
                 return None
-            # Try parsing common formats
-            formats = [
-                '%Y-%m-%d %H:%M:%S',
-                '%Y-%m-%d %H:%M:%S.%f',
-                '%Y/%m/%d %H:%M:%S',
-                '%Y-%m-%dT%H:%M:%S',
-                '%Y-%m-%dT%H:%M:%S.%f',
-                '%Y-%m-%dT%H:%M:%S.%fZ',
-                '%Y-%m-%dT%H:%M:%SZ',
-            ]
+            # Zero-padded strings are matched by one regex instead of a strptime per format
+            match = _DATETIME_PATTERN.fullmatch(datetime_str)
+            if match:
+                year, date_sep, month, day, time_sep, hour, minute, second, fraction, zulu = match.groups()
+                # '/' dates only come without fraction or 'Z'; 'Z' only follows a 'T' separator
+                if not (date_sep == '/' and (time_sep == 'T' or fraction or zulu)) and not (zulu and time_sep == ' '):
+                    try:
+                        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                                        int(fraction.ljust(6, '0')) if fraction else 0)
+                    except ValueError:
+                        pass
             
-            for fmt in formats:
+            # Try parsing common formats
+            for fmt in _PARSE_FORMATS:
                 try:
                     dt = datetime.strptime(datetime_str, fmt)
                     # Return naive datetime to match database format
@@ -168,29 +236,14 @@ class PersianDateTime:
         Returns:
             Persian weekday name
         """
+        # Naive datetimes are taken as Tehran wall-clock time, so their weekday needs no
+        # tzinfo at all; only other timezones are converted
         if dt is None:
-            dt = PersianDateTime.now_gregorian()
-        elif dt.tzinfo is None:
-            dt = TEHRAN_TZ.localize(dt)
-        else:
+            dt = datetime.now(TEHRAN_TZ)
+        elif dt.tzinfo is not None and dt.tzinfo is not TEHRAN_TZ:
             dt = dt.astimezone(TEHRAN_TZ)
         
-        weekday_names = {
-            0: 'شنبه',
-            1: 'یکشنبه',
-            2: 'دوشنبه',
-            3: 'سه‌شنبه',
-            4: 'چهارشنبه',
-            5: 'پنج‌شنبه',
-            6: 'جمعه'
-        }
-        
-        # Python's weekday: Monday is 0, Sunday is 6
-        # Persian week: Saturday is 0, Friday is 6
-        python_weekday = dt.weekday()
-        persian_weekday = (python_weekday + 2) % 7
-        
-        return weekday_names[persian_weekday]
+        return _PERSIAN_WEEKDAYS_BY_PY_WEEKDAY[dt.weekday()]
     
     @staticmethod
     def format_full_datetime(dt: Optional[datetime] = None) -> str:
@@ -210,14 +263,24 @@ class PersianDateTime:
         return f"{weekday}، {date} - ساعت {time}"
 
 
+# Messages call these several times while being built; within the same wall-clock
+# second the result cannot change, so it is rendered once per second
+@lru_cache(maxsize=4)
+def _now_persian_cached(epoch_sec: int) -> str:
+    return PersianDateTime.format_datetime(datetime.fromtimestamp(epoch_sec, TEHRAN_TZ))
+
+@lru_cache(maxsize=4)
+def _now_persian_date_cached(epoch_sec: int) -> str:
+    return PersianDateTime.format_date_persian(datetime.fromtimestamp(epoch_sec, TEHRAN_TZ))
+
 # Convenience functions
 def now_persian() -> str:
     """Get current datetime as Persian string"""
-    return PersianDateTime.format_datetime()
+    return _now_persian_cached(int(time.time()))
 
 def now_persian_date() -> str:
     """Get current date as Persian string"""
-    return PersianDateTime.format_date_persian()
+    return _now_persian_date_cached(int(time.time()))
 
 def now_persian_time() -> str:
     """Get current time as Persian string"""
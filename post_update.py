@@ -1,3 +1,4 @@
+import hashlib
 import os
 import subprocess
 import sys
@@ -28,39 +29,73 @@ def print_error(message):
 def print_warning(message):
     print(f"{Colors.WARNING}[WARNING] {message}{Colors.ENDC}")
 
-def run_command(command, cwd=None, shell=True):
-    """Runs a shell command and returns the output."""
+# Persistent wheel cache, so updates reuse already built/downloaded wheels
+PIP_CACHE_DIR = "/var/cache/hooshnet/pip"
+
+def file_sha256(path):
+    """Returns the hex SHA-256 of a file's contents."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def run_command(argv, cwd=None, check=True, env=None):
+    """Runs a command (argv list, no shell) and returns the output (with check=False, even if it exits non-zero)."""
     try:
         result = subprocess.run(
-            command,
+            argv,
             cwd=cwd,
-            shell=shell,
-            check=True,
+            shell=False,
+            check=check,
+            env=env,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True
         )
         return result.stdout.strip()
     except subprocess.CalledProcessError as e:
-        print_error(f"Command failed: {command}\nError: {e.stderr.strip()}")
+        print_error(f"Command failed: {' '.join(argv)}\nError: {e.stderr.strip()}")
+        return None
+    except OSError as e:
+        # Executable not found / not runnable; the shell used to report this as a failed command
+        print_error(f"Command failed: {' '.join(argv)}\nError: {e}")
         return None
 
 def main():
     print(f"\n{Colors.HEADER}{Colors.BOLD}=== Post-Update System Configuration ==={Colors.ENDC}")
     
     project_dir = os.path.dirname(os.path.abspath(__file__))
+    # One directory read answers every "does this top-level file exist" check below
+    with os.scandir(project_dir) as it:
+        entries = {entry.name: entry for entry in it}
     
     # 1. Update Dependencies
     print_step("Updating Python dependencies...")
     venv_python = os.path.join(project_dir, "venv", "bin", "python")
-    if not os.path.exists(venv_python):
+    # Hash of the requirements.txt last installed into the venv
+    requirements_marker = os.path.join(project_dir, "venv", ".requirements.sha256")
+    if "venv" not in entries or not os.path.exists(venv_python):
         print_warning("Virtual environment not found at venv/bin/python. Trying global python3...")
         venv_python = "python3"
+        requirements_marker = None
     
     # Install requirements
     req_file = os.path.join(project_dir, "requirements.txt")
-    if os.path.exists(req_file):
-        if run_command(f'"{venv_python}" -m pip install -r "{req_file}"'):
+    if "requirements.txt" in entries and entries["requirements.txt"].is_file():
+        req_hash = file_sha256(req_file)
+        installed_hash = None
+        if requirements_marker and os.path.exists(requirements_marker):
+            with open(requirements_marker) as f:
+                installed_hash = f.read().strip()
+        
+        if req_hash == installed_hash:
+            print_success("Dependencies already up to date (requirements.txt unchanged).")
+        elif run_command(
+            [venv_python, "-m", "pip", "install", "--prefer-binary", "--disable-pip-version-check",
+             "--no-input", "-r", req_file],
+            env={**os.environ, "PIP_CACHE_DIR": os.environ.get("PIP_CACHE_DIR", PIP_CACHE_DIR)}
+        ):
+             if requirements_marker:
+                 with open(requirements_marker, "w") as f:
+                     f.write(req_hash)
              print_success("Dependencies updated successfully.")
         else:
              print_error("Failed to update dependencies.")
@@ -69,34 +104,40 @@ def main():
 
     # 2. Fix Permissions
     print_step("Fixing file permissions and line endings...")
-    # dos2unix for all .sh and .py files
-    run_command(f'find "{project_dir}" -type f -name "*.py" -exec dos2unix {{}} + 2>/dev/null')
-    run_command(f'find "{project_dir}" -type f -name "*.sh" -exec dos2unix {{}} + 2>/dev/null')
+    # dos2unix for all .sh and .py files in one pass (find batches them per -exec ... +);
+    # the virtualenv and git metadata are not ours to convert
+    run_command([
+        "find", project_dir,
+        "(", "-path", os.path.join(project_dir, "venv"), "-o", "-path", os.path.join(project_dir, ".git"), ")", "-prune",
+        "-o", "-type", "f", "(", "-name", "*.py", "-o", "-name", "*.sh", ")",
+        "-exec", "dos2unix", "-q", "{}", "+",
+    ])
     
-    # chmod +x for scripts
+    # chmod +x for scripts, all in one call
     scripts = ["installer.sh", "start.sh", "stop.sh", "update.sh"]
-    for script in scripts:
-        script_path = os.path.join(project_dir, script)
-        if os.path.exists(script_path):
-            run_command(f'chmod +x "{script_path}"')
+    script_paths = [entries[script].path for script in scripts if script in entries]
+    if script_paths:
+        run_command(["chmod", "+x", *script_paths])
     print_success("Permissions fixed.")
 
     # 3. Restart Services
     print_step("Restarting services...")
     services = ["vpn-bot", "vpn-webapp"]
     
-    for service in services:
-        print(f"Restarting {service}...", end=" ", flush=True)
-        if run_command(f"systemctl restart {service}") is not None:
-            print(f"{Colors.GREEN}OK{Colors.ENDC}")
-        else:
-            print(f"{Colors.FAIL}FAILED{Colors.ENDC}")
+    # One systemctl call queues all restarts together and waits for them to finish
+    print(f"Restarting {', '.join(services)}...", end=" ", flush=True)
+    if run_command(["systemctl", "restart", *services]) is not None:
+        print(f"{Colors.GREEN}OK{Colors.ENDC}")
+    else:
+        print(f"{Colors.FAIL}FAILED{Colors.ENDC}")
 
     # 4. Verification
     print_step("Verifying service status...")
     all_active = True
-    for service in services:
-        status = run_command(f"systemctl is-active {service}")
+    # is-active prints one state per unit and exits non-zero if any is not active
+    output = run_command(["systemctl", "is-active", *services], check=False)
+    statuses = output.splitlines() if output else []
+    for service, status in zip(services, statuses + [None] * (len(services) - len(statuses))):
         if status == "active":
              print_success(f"Service {service} is active and running.")
         else:
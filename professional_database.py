@@ -10,11 +10,12 @@ import json
 import os
 import shutil
 import logging
-from typing import Dict, List, Optional, Tuple, Any
+from typing import Dict, Iterator, List, Optional, Tuple, Any
 from datetime import datetime, timedelta
 from contextlib import contextmanager
 import threading
 from config import MYSQL_CONFIG
+from cache_utils import invalidate_discount_code_cache, invalidate_gift_code_cache, invalidate_bot_text_cache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -26,6 +27,8 @@ class ProfessionalDatabaseManager:
     # Store connection pools per database name
     _connection_pools = {}  # {database_name: connection_pool}
     _pool_lock = threading.Lock()
+    # Databases whose schema, default texts and indexes were set up by this process
+    _initialized_databases = set()
     
     def __init__(self, db_config: dict = None):
         self.db_config = db_config or MYSQL_CONFIG.copy()
@@ -41,6 +44,12 @@ class ProfessionalDatabaseManager:
         # Ensure backup directory exists
         os.makedirs(self.backup_dir, exist_ok=True)
         
+        # Schema setup is per database, not per instance: further instances for a
+        # database that is already set up only attach to its shared connection pool
+        if self.database_name in ProfessionalDatabaseManager._initialized_databases:
+            self._init_connection_pool()
+            return
+        
         # Ensure database exists BEFORE initializing connection pool
         self._ensure_database_exists()
         
@@ -75,6 +84,15 @@ class ProfessionalDatabaseManager:
             logger.warning("Database optimization module not available, skipping index creation")
         except Exception as e:
             logger.warning(f"Could not create database indexes: {e}")
+        
+        ProfessionalDatabaseManager._initialized_databases.add(self.database_name)
+    
+    @classmethod
+    def for_database(cls, database_name: Optional[str] = None) -> 'ProfessionalDatabaseManager':
+        """Create a manager for another database on the configured MySQL server (default: MYSQL_CONFIG's)"""
+        if not database_name:
+            return cls(db_config=MYSQL_CONFIG)
+        return cls(db_config={**MYSQL_CONFIG, 'database': database_name})
     
     def _init_connection_pool(self):
         """Initialize MySQL connection pool for this specific database"""
@@ -157,15 +175,20 @@ class ProfessionalDatabaseManager:
                     logger.error(f"❌ Error initializing connection pool for '{self.database_name}': {e}")
                     raise Error(f"No connection pool found for database '{self.database_name}' and failed to initialize: {e}. Available pools: {list(ProfessionalDatabaseManager._connection_pools.keys())}")
             conn = pool.get_connection()
-            # Verify connection is using correct database
-            cursor = conn.cursor()
-            cursor.execute("SELECT DATABASE() as db")
-            result = cursor.fetchone()
-            actual_db = result[0] if result else None
-            cursor.close()
-            if actual_db != self.database_name:
-                logger.error(f"❌ CRITICAL: Connection pool for '{self.database_name}' is connected to wrong database '{actual_db}'!")
-                raise Error(f"Connection pool mismatch: expected '{self.database_name}', got '{actual_db}'")
+            # Verify connection is using correct database. Pooled connections keep
+            # their database across checkouts, so each physical connection is only
+            # checked once instead of paying a round-trip on every checkout
+            raw_conn = getattr(conn, '_cnx', conn)
+            if getattr(raw_conn, '_verified_database', None) != self.database_name:
+                cursor = conn.cursor()
+                cursor.execute("SELECT DATABASE() as db")
+                result = cursor.fetchone()
+                actual_db = result[0] if result else None
+                cursor.close()
+                if actual_db != self.database_name:
+                    logger.error(f"❌ CRITICAL: Connection pool for '{self.database_name}' is connected to wrong database '{actual_db}'!")
+                    raise Error(f"Connection pool mismatch: expected '{self.database_name}', got '{actual_db}'")
+                raw_conn._verified_database = actual_db
             yield conn
         except Error as e:
             logger.error(f"Database error: {e}")
@@ -3319,6 +3342,96 @@ class ProfessionalDatabaseManager:
             logger.error(f"Error getting invoice: {e}")
             return None
     
+    def get_invoice_with_payer(self, invoice_id: int, telegram_id: int) -> Optional[Dict]:
+        """
+        Get invoice by ID together with the paying user's id and balance in one query
+        
+        payer_id/payer_balance are None when no user has the given telegram ID;
+        product_name is None when the invoice has no (existing) product.
+        """
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute('''
+                    SELECT i.*, u.id AS payer_id, u.balance AS payer_balance,
+                           p.name AS product_name
+                    FROM invoices i
+                    LEFT JOIN users u ON u.telegram_id = %s
+                    LEFT JOIN products p ON p.id = i.product_id
+                    WHERE i.id = %s
+                ''', (telegram_id, invoice_id))
+                row = cursor.fetchone()
+                return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"Error getting invoice with payer: {e}")
+            return None
+    
+    def pay_invoice_with_balance(self, invoice_id: int, telegram_id: int, amount: int,
+                                 transaction_type: str, description: str = None,
+                                 discount_usage: Optional[Dict] = None) -> Tuple[bool, Optional[str]]:
+        """
+        Mark an invoice paid and deduct its amount from the user's balance in one transaction
+        
+        The invoice and user rows are locked (SELECT ... FOR UPDATE) before the status and
+        balance are re-checked, so two concurrent payments cannot both spend the same
+        balance or pay the same invoice twice. discount_usage, when given, holds code_id,
+        amount_before, discount_amount and amount_after of the discount to record.
+        Returns (success, error_message); error_message is None on database errors.
+        """
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute('SELECT status FROM invoices WHERE id = %s FOR UPDATE', (invoice_id,))
+                invoice = cursor.fetchone()
+                if not invoice:
+                    conn.rollback()
+                    return False, 'Invoice not found'
+                if invoice['status'] == 'paid':
+                    conn.rollback()
+                    return False, 'Invoice already paid'
+                
+                cursor.execute('SELECT id, balance FROM users WHERE telegram_id = %s FOR UPDATE', (telegram_id,))
+                user = cursor.fetchone()
+                if not user:
+                    conn.rollback()
+                    return False, 'User not found'
+                if user['balance'] < amount:
+                    conn.rollback()
+                    return False, 'Insufficient balance'
+                
+                if discount_usage:
+                    cursor.execute('''
+                        INSERT INTO discount_code_usage
+                        (code_id, user_id, invoice_id, amount_before_discount, discount_amount, amount_after_discount)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                    ''', (discount_usage['code_id'], user['id'], invoice_id, discount_usage['amount_before'],
+                          discount_usage['discount_amount'], discount_usage['amount_after']))
+                    cursor.execute('''
+                        UPDATE discount_codes SET used_count = used_count + 1
+                        WHERE id = %s
+                    ''', (discount_usage['code_id'],))
+                
+                cursor.execute('''
+                    UPDATE invoices SET status = 'paid', paid_at = CURRENT_TIMESTAMP
+                    WHERE id = %s
+                ''', (invoice_id,))
+                cursor.execute('UPDATE users SET balance = balance - %s WHERE id = %s', (amount, user['id']))
+                cursor.execute('''
+                    INSERT INTO balance_transactions (user_id, amount, transaction_type, description)
+                    VALUES (%s, %s, %s, %s)
+                ''', (user['id'], -amount, transaction_type, description))
+                
+                conn.commit()
+            
+            if discount_usage:
+                invalidate_discount_code_cache(self.database_name, discount_usage['code_id'])
+            self.log_system_event('INFO', f'Balance updated for user {telegram_id}: {-amount}', 'balance_management', telegram_id)
+            return True, None
+        except Exception as e:
+            logger.error(f"Error paying invoice with balance: {e}")
+            # Database error text is logged above, never returned to be shown to users
+            return False, None
+    
     def update_invoice_payment_link(self, invoice_id: int, payment_link: str, order_id: str = None) -> bool:
         """Update invoice payment link and order ID"""
         try:
@@ -4026,35 +4139,50 @@ class ProfessionalDatabaseManager:
             logger.error(f"Error getting discount code by ID: {e}")
             return None
     
-    def validate_discount_code(self, code: str, user_id: int, amount: int) -> Tuple[bool, Optional[str], Optional[Dict]]:
-        """Validate discount code for a user and amount"""
+    @staticmethod
+    def check_discount_code_rules(discount_code: Optional[Dict], amount: int, now: datetime) -> Optional[str]:
+        """
+        Check the row-level rules of a discount code (active, validity window, max uses,
+        minimum purchase) as of `now`; returns the error message, or None if they pass
+        """
+        if not discount_code:
+            return "کد تخفیف یافت نشد"
+        
+        if not discount_code['is_active']:
+            return "کد تخفیف غیرفعال است"
+        
+        # Check date validity
+        if discount_code['valid_from']:
+            valid_from = datetime.fromisoformat(discount_code['valid_from']) if isinstance(discount_code['valid_from'], str) else discount_code['valid_from']
+            if now < valid_from:
+                return f"کد تخفیف از تاریخ {valid_from.strftime('%Y-%m-%d')} فعال می‌شود"
+        
+        if discount_code['valid_until']:
+            valid_until = datetime.fromisoformat(discount_code['valid_until']) if isinstance(discount_code['valid_until'], str) else discount_code['valid_until']
+            if now > valid_until:
+                return "کد تخفیف منقضی شده است"
+        
+        # Check max uses
+        if discount_code['max_uses'] > 0 and discount_code['used_count'] >= discount_code['max_uses']:
+            return "حداکثر تعداد استفاده از این کد تخفیف به پایان رسیده است"
+        
+        # Check min purchase amount
+        if discount_code['min_purchase_amount'] > 0 and amount < discount_code['min_purchase_amount']:
+            return f"حداقل مبلغ خرید برای استفاده از این کد تخفیف {discount_code['min_purchase_amount']:,} تومان است"
+        
+        return None
+    
+    def validate_discount_code(self, code: str, user_id: int, amount: int,
+                               now: Optional[datetime] = None) -> Tuple[bool, Optional[str], Optional[Dict]]:
+        """Validate discount code for a user and amount, as of `now` (default: current time)"""
         try:
             discount_code = self.get_discount_code(code)
-            if not discount_code:
-                return False, "کد تخفیف یافت نشد", None
-            
-            if not discount_code['is_active']:
-                return False, "کد تخفیف غیرفعال است", None
-            
-            # Check date validity
-            now = datetime.now()
-            if discount_code['valid_from']:
-                valid_from = datetime.fromisoformat(discount_code['valid_from']) if isinstance(discount_code['valid_from'], str) else discount_code['valid_from']
-                if now < valid_from:
-                    return False, f"کد تخفیف از تاریخ {valid_from.strftime('%Y-%m-%d')} فعال می‌شود", None
-            
-            if discount_code['valid_until']:
-                valid_until = datetime.fromisoformat(discount_code['valid_until']) if isinstance(discount_code['valid_until'], str) else discount_code['valid_until']
-                if now > valid_until:
-                    return False, "کد تخفیف منقضی شده است", None
-            
-            # Check max uses
-            if discount_code['max_uses'] > 0 and discount_code['used_count'] >= discount_code['max_uses']:
-                return False, "حداکثر تعداد استفاده از این کد تخفیف به پایان رسیده است", None
             
-            # Check min purchase amount
-            if discount_code['min_purchase_amount'] > 0 and amount < discount_code['min_purchase_amount']:
-                return False, f"حداقل مبلغ خرید برای استفاده از این کد تخفیف {discount_code['min_purchase_amount']:,} تومان است", None
+            if now is None:
+                now = datetime.now()
+            error_message = self.check_discount_code_rules(discount_code, amount, now)
+            if error_message:
+                return False, error_message, None
             
             # Check if user already used this code
             with self.get_connection() as conn:
@@ -4093,6 +4221,7 @@ class ProfessionalDatabaseManager:
                 ''', (code_id,))
                 
                 conn.commit()
+                invalidate_discount_code_cache(self.database_name, code_id)
                 return True
         except Exception as e:
             logger.error(f"Error applying discount code: {e}")
@@ -4139,6 +4268,7 @@ class ProfessionalDatabaseManager:
                 query = f"UPDATE discount_codes SET {', '.join(updates)} WHERE id = %s"
                 cursor.execute(query, params)
                 conn.commit()
+                invalidate_discount_code_cache(self.database_name, code_id)
                 return True
         except Exception as e:
             logger.error(f"Error updating discount code: {e}")
@@ -4151,6 +4281,7 @@ class ProfessionalDatabaseManager:
                 cursor = conn.cursor(dictionary=True)
                 cursor.execute('DELETE FROM discount_codes WHERE id = %s', (code_id,))
                 conn.commit()
+                invalidate_discount_code_cache(self.database_name, code_id)
                 return True
         except Exception as e:
             logger.error(f"Error deleting discount code: {e}")
@@ -4274,6 +4405,7 @@ class ProfessionalDatabaseManager:
                 ''', (user_id, amount, 'gift_code', f'Gift code redemption'))
                 
                 conn.commit()
+                invalidate_gift_code_cache(self.database_name, code_id)
                 return True
         except Exception as e:
             logger.error(f"Error applying gift code: {e}")
@@ -4319,6 +4451,7 @@ class ProfessionalDatabaseManager:
                 query = f"UPDATE gift_codes SET {', '.join(updates)} WHERE id = %s"
                 cursor.execute(query, params)
                 conn.commit()
+                invalidate_gift_code_cache(self.database_name, code_id)
                 return True
         except Exception as e:
             logger.error(f"Error updating gift code: {e}")
@@ -4331,6 +4464,7 @@ class ProfessionalDatabaseManager:
                 cursor = conn.cursor(dictionary=True)
                 cursor.execute('DELETE FROM gift_codes WHERE id = %s', (code_id,))
                 conn.commit()
+                invalidate_gift_code_cache(self.database_name, code_id)
                 return True
         except Exception as e:
             logger.error(f"Error deleting gift code: {e}")
@@ -4345,20 +4479,12 @@ class ProfessionalDatabaseManager:
                     SELECT 
                         COUNT(*) as total_uses,
                         SUM(discount_amount) as total_discount,
-                        SUM(amount_after_discount) as total_revenue
+                        SUM(amount_after_discount) as total_revenue,
+                        COUNT(DISTINCT user_id) as unique_users
                     FROM discount_code_usage
                     WHERE code_id = %s
                 ''', (code_id,))
-                stats = dict(cursor.fetchone())
-                
-                cursor.execute('''
-                    SELECT COUNT(DISTINCT user_id) as unique_users
-                    FROM discount_code_usage
-                    WHERE code_id = %s
-                ''', (code_id,))
-                stats.update(dict(cursor.fetchone()))
-                
-                return stats
+                return dict(cursor.fetchone())
         except Exception as e:
             logger.error(f"Error getting discount code statistics: {e}")
             return {}
@@ -4371,24 +4497,123 @@ class ProfessionalDatabaseManager:
                 cursor.execute('''
                     SELECT 
                         COUNT(*) as total_uses,
-                        SUM(amount) as total_amount
+                        SUM(amount) as total_amount,
+                        COUNT(DISTINCT user_id) as unique_users
                     FROM gift_code_usage
                     WHERE code_id = %s
                 ''', (code_id,))
-                stats = dict(cursor.fetchone())
-                
-                cursor.execute('''
-                    SELECT COUNT(DISTINCT user_id) as unique_users
-                    FROM gift_code_usage
-                    WHERE code_id = %s
-                ''', (code_id,))
-                stats.update(dict(cursor.fetchone()))
-                
-                return stats
+                return dict(cursor.fetchone())
         except Exception as e:
             logger.error(f"Error getting gift code statistics: {e}")
             return {}
     
+    _DISCOUNT_CODES_WITH_STATS_QUERY = '''
+        SELECT c.*,
+               COALESCE(u.total_uses, 0) as total_uses,
+               COALESCE(u.total_discount, 0) as total_discount,
+               COALESCE(u.total_revenue, 0) as total_revenue,
+               COALESCE(u.unique_users, 0) as unique_users
+        FROM discount_codes c
+        LEFT JOIN (
+            SELECT code_id,
+                   COUNT(*) as total_uses,
+                   SUM(discount_amount) as total_discount,
+                   SUM(amount_after_discount) as total_revenue,
+                   COUNT(DISTINCT user_id) as unique_users
+            FROM discount_code_usage
+            GROUP BY code_id
+        ) u ON u.code_id = c.id
+    '''
+    
+    _GIFT_CODES_WITH_STATS_QUERY = '''
+        SELECT c.*,
+               COALESCE(u.total_uses, 0) as total_uses,
+               COALESCE(u.total_amount, 0) as total_amount,
+               COALESCE(u.unique_users, 0) as unique_users
+        FROM gift_codes c
+        LEFT JOIN (
+            SELECT code_id,
+                   COUNT(*) as total_uses,
+                   SUM(amount) as total_amount,
+                   COUNT(DISTINCT user_id) as unique_users
+            FROM gift_code_usage
+            GROUP BY code_id
+        ) u ON u.code_id = c.id
+    '''
+    
+    @staticmethod
+    def _codes_with_stats_query(base_query: str, active_only: bool) -> str:
+        query = base_query
+        if active_only:
+            query += " WHERE c.is_active = 1"
+        return query + " ORDER BY c.created_at DESC"
+    
+    def _iter_rows(self, query: str, params: tuple = (), batch_size: int = 256) -> Iterator[Dict]:
+        """
+        Stream rows of a query in batches of `batch_size` through an unbuffered cursor
+        
+        The pooled connection stays checked out until the iterator is exhausted or closed.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor(dictionary=True, buffered=False)
+            try:
+                cursor.execute(query, params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                # Drain rows left by an early-closed iterator so the connection
+                # can go back to the pool
+                if conn.unread_result:
+                    conn.consume_results()
+                cursor.close()
+    
+    def iter_all_discount_codes_with_stats(self, active_only: bool = False,
+                                           batch_size: int = 256) -> Iterator[Dict]:
+        """Iterate discount codes with their usage statistics without materializing the result set"""
+        try:
+            yield from self._iter_rows(
+                self._codes_with_stats_query(self._DISCOUNT_CODES_WITH_STATS_QUERY, active_only),
+                batch_size=batch_size
+            )
+        except Exception as e:
+            logger.error(f"Error getting discount codes with statistics: {e}")
+    
+    def iter_all_gift_codes_with_stats(self, active_only: bool = False,
+                                       batch_size: int = 256) -> Iterator[Dict]:
+        """Iterate gift codes with their usage statistics without materializing the result set"""
+        try:
+            yield from self._iter_rows(
+                self._codes_with_stats_query(self._GIFT_CODES_WITH_STATS_QUERY, active_only),
+                batch_size=batch_size
+            )
+        except Exception as e:
+            logger.error(f"Error getting gift codes with statistics: {e}")
+    
+    def get_all_discount_codes_with_stats(self, active_only: bool = False) -> List[Dict]:
+        """Get all discount codes with their usage statistics in one query"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute(self._codes_with_stats_query(self._DISCOUNT_CODES_WITH_STATS_QUERY, active_only))
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Error getting discount codes with statistics: {e}")
+            return []
+    
+    def get_all_gift_codes_with_stats(self, active_only: bool = False) -> List[Dict]:
+        """Get all gift codes with their usage statistics in one query"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute(self._codes_with_stats_query(self._GIFT_CODES_WITH_STATS_QUERY, active_only))
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Error getting gift codes with statistics: {e}")
+            return []
+    
     # Reserved Services Management Methods
     def add_reserved_service(self, client_id: int, product_id: int, volume_gb: int, duration_days: int) -> int:
         """Add a reserved service for renewal"""
@@ -5224,8 +5449,13 @@ class ProfessionalDatabaseManager:
     
     # ========== BOT TEXT MANAGEMENT METHODS ==========
     
-    def get_bot_text(self, text_key: str) -> Optional[Dict]:
-        """Get bot text by key - always fresh from database, no cache"""
+    def get_bot_text(self, text_key: str, raise_errors: bool = False) -> Optional[Dict]:
+        """
+        Get bot text by key - always fresh from database, no cache
+        
+        On a database error this logs and returns None, or re-raises without logging
+        if `raise_errors` is set (the caller then decides how to log it)
+        """
         try:
             # Force a fresh connection to ensure we get latest data
             with self.get_connection() as conn:
@@ -5269,13 +5499,21 @@ class ProfessionalDatabaseManager:
                 
                 return result
         except Exception as e:
+            if raise_errors:
+                raise
             logger.error(f"❌ Error getting bot text '{text_key}': {e}")
             import traceback
             logger.error(traceback.format_exc())
             return None
     
-    def get_all_bot_texts(self, category: str = None, include_inactive: bool = False) -> List[Dict]:
-        """Get all bot texts for this database, optionally filtered by category"""
+    def get_all_bot_texts(self, category: str = None, include_inactive: bool = False,
+                          raise_errors: bool = False) -> List[Dict]:
+        """
+        Get all bot texts for this database, optionally filtered by category
+        
+        On a database error this logs and returns [], or re-raises if `raise_errors` is set
+        (for callers that must tell "no texts" from "query failed").
+        """
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor(dictionary=True)
@@ -5298,6 +5536,8 @@ class ProfessionalDatabaseManager:
                 return [dict(row) for row in cursor.fetchall()]
         except Exception as e:
             logger.error(f"Error getting all bot texts: {e}")
+            if raise_errors:
+                raise
             return []
     
     def create_bot_text(self, text_key: str, text_category: str, text_content: str, 
@@ -5344,6 +5584,7 @@ class ProfessionalDatabaseManager:
                     cursor.execute(query, params)
                     affected = cursor.rowcount
                     conn.commit()
+                    invalidate_bot_text_cache(self.database_name)
                     if affected > 0:
                         logger.info(f"✅ Successfully updated text '{text_key}' for database '{self.database_name}' (affected rows: {affected})")
                     else:
@@ -5365,6 +5606,7 @@ class ProfessionalDatabaseManager:
                         VALUES (%s, %s, %s, %s, %s, %s, %s)
                     ''', (self.database_name, text_key, text_category, text_content, description, available_variables, updated_by))
                     conn.commit()
+                    invalidate_bot_text_cache(self.database_name)
                     logger.info(f"✅ Successfully created text '{text_key}' with ID {cursor.lastrowid} for database '{self.database_name}'")
                     return cursor.lastrowid
         except Exception as e:
@@ -5411,6 +5653,7 @@ class ProfessionalDatabaseManager:
                 query = f'UPDATE bot_texts SET {", ".join(updates)} WHERE database_name = %s AND text_key = %s'
                 cursor.execute(query, params)
                 conn.commit()
+                invalidate_bot_text_cache(self.database_name)
                 return cursor.rowcount > 0
         except Exception as e:
             logger.error(f"Error updating bot text: {e}")
@@ -5436,6 +5679,7 @@ class ProfessionalDatabaseManager:
                     WHERE database_name = %s AND text_key = %s
                 ''', (self.database_name, text_key))
                 conn.commit()
+                invalidate_bot_text_cache(self.database_name)
                 
                 affected_rows = cursor.rowcount
                 if affected_rows > 0:
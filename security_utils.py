@@ -4,48 +4,197 @@ Provides rate limiting, input sanitization, and other security features
 """
 
 import time
+import math
 import hashlib
 import hmac
 import re
 import html
 import os
+import threading
 from functools import wraps
 from typing import Dict, Optional, Callable, Tuple
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime, timedelta
 from flask import request, session, jsonify, g, Response
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Rate limiting storage (in production, use Redis)
-_rate_limit_storage: Dict[str, list] = defaultdict(list)
+_sha256 = hashlib.sha256
+
+# Rate limiting storage (in production, use Redis): token bucket per "ip:endpoint" key,
+# as [tokens, last_refill_timestamp] so it is updated in place
+_rate_limit_buckets: Dict[str, list] = {}
 _rate_limit_lock = {}
 
+# Stricter buckets for IPs with recent suspicious activity, same keys
+_suspicious_rate_limit_buckets: Dict[str, list] = {}
+SUSPICIOUS_MAX_REQUESTS = 2  # Limit to 2 requests per minute for suspicious IPs
+SUSPICIOUS_RATE_WINDOW = 60
+
 # IP blocking storage - tracks blocked IPs and their unblock time
-_blocked_ips: Dict[str, float] = {}  # IP -> unblock timestamp
+_blocked_ips: Dict[str, float] = {}  # IP -> unblock time (time.monotonic())
+
+# Suspicious activity tracking - tracks suspicious activities per IP, oldest first
+# IP -> deque of (timestamp, activity_type, path); defined below the thresholds it is sized from
 
-# Suspicious activity tracking - tracks suspicious activities per IP
-_suspicious_activity: Dict[str, list] = defaultdict(list)  # IP -> list of (timestamp, activity_type, path)
+# Expired rate-limit buckets, IP blocks and suspicious activity are swept by a
+# background janitor thread every JANITOR_INTERVAL seconds, off the request path
+JANITOR_INTERVAL = 30
+_janitor_lock = threading.Lock()
+_janitor_thread: Optional[threading.Thread] = None
 
 # Attack pattern detection thresholds
 MAX_SUSPICIOUS_ACTIVITIES = 3  # Block after 3 suspicious activities (more aggressive)
 BLOCK_DURATION_HOURS = 48  # Block for 48 hours (longer block)
 SUSPICIOUS_ACTIVITY_WINDOW = 300  # 5 minutes window
 
+# Only the last few activities matter for the threshold, so history per IP is bounded
+_suspicious_activity: Dict[str, deque] = defaultdict(lambda: deque(maxlen=MAX_SUSPICIOUS_ACTIVITIES * 4))
+_suspicious_activity_lock = threading.Lock()
+
+# Validation patterns, compiled once instead of per call (re's internal cache is small)
+_CLIENT_NAME_RE = re.compile(r'^[a-zA-Z0-9_\-\u0600-\u06FF\s]+$')
+_DISCOUNT_CODE_RE = re.compile(r'^[A-Z0-9]+$')
+_URL_RE = re.compile(
+    r'^https?://'  # http:// or https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+_FILENAME_STRIP_RE = re.compile(r'[<>:"|?*]')
+
+# Path traversal in one scan: traversal sequences (plain, URL-encoded, double-encoded and
+# mixed; case-insensitive), absolute Linux system paths, and Windows drive letters
+_TRAVERSAL_RE = re.compile(
+    r'(?i:\.\./|\.\.\\|%2e%2e%2f|%2e%2e%5c|%252e%252e%252f|\.\.%2f|\.\.%5c)'
+    r'|^/(?:etc|proc|sys)/'
+    r'|^[a-zA-Z]:\\'
+)
+
+# Request checks: headers scanned for null bytes, and the accepted HTTP methods
+_UNTRUSTED_HEADERS = ('User-Agent', 'Referer', 'X-Forwarded-For')
+_ALLOWED_METHODS = frozenset(('GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS'))
+
+# Legitimate static files (by extension or directory) skip attack-pattern detection
+_STATIC_EXTENSIONS = ('.css', '.js', '.jpg', '.jpeg', '.png', '.gif', '.svg',
+                      '.woff', '.woff2', '.ttf', '.eot', '.ico', '.webp')
+_STATIC_DIR_RE = re.compile(r'/(?:static|css|js|images)/')
+
+# Attack signatures checked against the lower-cased request path, as (attack_type, patterns)
+# in priority order: when patterns of several types match, the first type listed wins
+_ATTACK_PATTERNS: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    # PHP exploitation attempts (from logs: phpinfo, config.php, etc.)
+    ('php_exploitation', (
+        'phpunit', 'eval-stdin', 'phpinfo', 'php://', 'phar://',
+        'vendor/phpunit', 'composer.json', 'composer.lock',
+        'config.php', 'pinfo.php', 'test.php', 'info.php',
+        '?phpinfo', 'phpinfo=-1', 'phpinfo()'
+    )),
+    # WordPress scanning
+    ('wordpress_scanning', (
+        'wp-admin', 'wp-includes', 'wp-content', 'xmlrpc.php',
+        'wlwmanifest.xml', 'wp-config.php', 'wp-login.php'
+    )),
+    # Sensitive file access (from logs: .env, .git, robots.txt, etc.)
+    ('sensitive_file_access', (
+        '.env', '.git', '.svn', '.hg', '.bzr',  # Version control
+        '.sql', '.db', '.sqlite', '.sqlite3',  # Databases
+        'config.yaml', 'config.yml', 'docker-compose',  # Config files
+        'credentials', 'secrets', 'private',  # Sensitive names
+        '.backup', 'backup.sql', 'backup.zip', 'backup.tar', 'backup.tgz',  # Backup files
+        '.pem', '.key', '.crt', '.p12', '.pfx',  # Certificates
+        'phpinfo', 'info.php', 'test.php',  # Info disclosure
+        'admin.php', 'login.php', 'config.php',  # Admin files
+        'robots.txt',  # Common scanning target
+        'client_secrets.json',  # OAuth secrets
+        'appsettings.json',  # .NET config
+    )),
+    # CGI/Shell access attempts (from logs: /cgi-bin/luci/)
+    ('shell_access_attempt', (
+        '/cgi-bin/', '/bin/sh', '/bin/bash', '/usr/bin/env',
+        'cmd.exe', 'powershell.exe', 'wmic.exe',
+        'cgi-bin/luci', 'cgi-bin/', '/locale'
+    )),
+    # Cisco router exploits
+    ('cisco_exploit', ('/+csco', '/+csce')),
+    # Laravel/Symfony exploits (from logs: app_dev.php, _profiler/)
+    ('framework_exploit', (
+        '/.env', '/app_dev.php', '/_profiler/', '/debug/',
+        '/api/.env', '/laravel/.env', '/backend/.env',
+        '/misc/.env', '/content/.env', '/docker/.env',
+        '/env/.env', '/Dev/.env', '/cron/.env',
+        '/localhost/.env', '/.gitlab-ci/.env',
+        '/laravel/.env.production', '/local/.env.prod',
+        '/public/.env', '/frontend/.env', '/locally/.env',
+        '/v2/.env', '/lab/.env', '/.vscode/.env',
+        '/.env.backup', '/.env.example'
+    )),
+    # Java exploitation (from logs: actuator/gateway/routes)
+    ('java_exploit', (
+        'actuator', '/gateway/routes', '.jar',
+        'spring-boot-actuator', '/actuator/'
+    )),
+    # XDEBUG exploitation attempts (from logs: ?XDEBUG_SESSION_START=phpstorm)
+    ('xdebug_exploit', ('xdebug', 'xdebug_session')),
+    # Development server scanning (from logs: developmentserver/metadatauploader)
+    ('dev_server_scanning', (
+        'developmentserver', 'metadatauploader', 'dev.php',
+        'development', 'staging', 'test.php'
+    )),
+    # HTTP/2.0 protocol attacks (from logs: PRI * HTTP/2.0)
+    ('http2_protocol_attack', ('http/2.0', 'pri *')),
+)
+
+def _build_attack_automaton():
+    """Aho-Corasick automaton mapping every attack pattern to its _ATTACK_PATTERNS index"""
+    automaton = ahocorasick.Automaton()
+    for priority, (_, patterns) in reversed(list(enumerate(_ATTACK_PATTERNS))):
+        for pattern in patterns:
+            # Listed in several types: keep the highest-priority one
+            automaton.add_word(pattern, priority)
+    automaton.make_automaton()
+    return automaton
+
+# Optional: with pyahocorasick installed, all patterns are matched in one pass over the path
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+_ATTACK_AUTOMATON = _build_attack_automaton() if ahocorasick is not None else None
+
 def clean_rate_limit_storage():
     """Clean old entries from rate limit storage"""
-    current_time = time.time()
-    keys_to_remove = []
+    current_time = time.monotonic()
     
-    for key, timestamps in _rate_limit_storage.items():
-        # Keep only entries from last hour
-        _rate_limit_storage[key] = [ts for ts in timestamps if current_time - ts < 3600]
-        if not _rate_limit_storage[key]:
-            keys_to_remove.append(key)
+    for buckets in (_rate_limit_buckets, _suspicious_rate_limit_buckets):
+        # Buckets idle for an hour have long refilled; dropping them is equivalent
+        # Snapshot items: request threads keep inserting while the janitor sweeps
+        keys_to_remove = [key for key, bucket in list(buckets.items()) if current_time - bucket[1] >= 3600]
+        for key in keys_to_remove:
+            buckets.pop(key, None)
+
+def _take_token(buckets: Dict[str, list], key: str, capacity: int, window_seconds: float,
+                current_time: float) -> float:
+    """
+    Take one request token from a key's bucket, refilling it lazily first
     
-    for key in keys_to_remove:
-        del _rate_limit_storage[key]
+    The bucket holds up to `capacity` tokens and refills at capacity/window_seconds per
+    second. Returns 0 if a token was taken, otherwise the seconds until one is available.
+    """
+    rate = capacity / window_seconds
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = [capacity, current_time]
+    else:
+        bucket[0] = min(capacity, bucket[0] + (current_time - bucket[1]) * rate)
+        bucket[1] = current_time
+    
+    if bucket[0] < 1:
+        return (1 - bucket[0]) / rate
+    bucket[0] -= 1
+    return 0
 
 def rate_limit(max_requests: int = 10, window_seconds: int = 60, key_func: Optional[Callable] = None):
     """
@@ -69,30 +218,18 @@ def rate_limit(max_requests: int = 10, window_seconds: int = 60, key_func: Optio
             # Add route name to key for per-route limiting
             route_key = f"{key}:{request.endpoint}"
             
-            current_time = time.time()
-            
-            # Clean old entries periodically
-            if current_time % 60 < 1:  # Clean every minute
-                clean_rate_limit_storage()
-            
-            # Get timestamps for this key
-            timestamps = _rate_limit_storage[route_key]
-            
-            # Remove old timestamps outside the window
-            timestamps[:] = [ts for ts in timestamps if current_time - ts < window_seconds]
+            current_time = time.monotonic()
             
             # Check if limit exceeded
-            if len(timestamps) >= max_requests:
-                logger.warning(f"Rate limit exceeded for {route_key}: {len(timestamps)} requests in {window_seconds}s")
+            retry_after = _take_token(_rate_limit_buckets, route_key, max_requests, window_seconds, current_time)
+            if retry_after:
+                logger.warning(f"Rate limit exceeded for {route_key}: more than {max_requests} requests in {window_seconds}s")
                 return jsonify({
                     'success': False,
                     'message': 'Too many requests. Please try again later.',
-                    'retry_after': window_seconds
+                    'retry_after': math.ceil(retry_after)
                 }), 429
             
-            # Add current timestamp
-            timestamps.append(current_time)
-            
             return f(*args, **kwargs)
         return decorated_function
     return decorator
@@ -116,7 +253,9 @@ def sanitize_input(text: str, max_length: Optional[int] = None) -> str:
     # Remove null bytes
     text = text.replace('\x00', '')
     
-    # HTML escape to prevent XSS
+    # HTML escape to prevent XSS. Kept on html.escape: its chained str.replace calls
+    # beat a str.translate table here, since translate has no fast path for
+    # multi-character replacements and most input is non-ASCII (Persian)
     text = html.escape(text)
     
     # Limit length
@@ -134,7 +273,7 @@ def sanitize_filename(filename: str) -> str:
     filename = filename.replace('\x00', '')
     
     # Remove dangerous characters
-    filename = re.sub(r'[<>:"|?*]', '', filename)
+    filename = _FILENAME_STRIP_RE.sub('', filename)
     
     # Limit length
     filename = filename[:255]
@@ -186,7 +325,7 @@ def validate_client_name(name: str) -> bool:
         return False
     
     # Allow alphanumeric, dash, underscore, and Persian characters
-    if not re.match(r'^[a-zA-Z0-9_\-\u0600-\u06FF\s]+$', name):
+    if not _CLIENT_NAME_RE.match(name):
         return False
     
     return True
@@ -201,7 +340,7 @@ def validate_discount_code(code: str) -> bool:
         return False
     
     # Allow alphanumeric and uppercase
-    if not re.match(r'^[A-Z0-9]+$', code.upper()):
+    if not _DISCOUNT_CODE_RE.match(code.upper()):
         return False
     
     return True
@@ -212,19 +351,16 @@ def validate_url(url: str) -> bool:
         return False
     
     # Basic URL validation
-    url_pattern = re.compile(
-        r'^https?://'  # http:// or https://
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
-        r'localhost|'  # localhost...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
-        r'(?::\d+)?'  # optional port
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-    
-    return bool(url_pattern.match(url))
+    return bool(_URL_RE.match(url))
 
 def hash_password(password: str) -> str:
-    """Hash password using SHA256 (for non-critical passwords)"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """
+    Hash password using SHA256 (for non-critical passwords)
+    
+    Unsalted and fast by design, so not suitable for stored user credentials;
+    use a salted KDF (e.g. werkzeug.security.generate_password_hash) for those.
+    """
+    return _sha256(password.encode()).hexdigest()
 
 def constant_time_compare(a: str, b: str) -> bool:
     """Constant-time string comparison to prevent timing attacks"""
@@ -239,19 +375,23 @@ def get_client_ip() -> str:
     else:
         return request.remote_addr or 'unknown'
 
+def _expire_activities(activities: deque, current_time: float):
+    """Pop activities older than SUSPICIOUS_ACTIVITY_WINDOW off the left of an IP's deque"""
+    while activities and current_time - activities[0][0] >= SUSPICIOUS_ACTIVITY_WINDOW:
+        activities.popleft()
+
 def record_suspicious_activity(ip: str, activity: str, path: str):
     """Record suspicious activity from an IP and auto-block if threshold exceeded"""
-    current_time = time.time()
+    current_time = time.monotonic()
     
-    # Clean old activities
-    if ip in _suspicious_activity:
-        _suspicious_activity[ip] = [
-            (ts, act, p) for ts, act, p in _suspicious_activity[ip]
-            if current_time - ts < SUSPICIOUS_ACTIVITY_WINDOW
-        ]
-    
-    # Record new activity
-    _suspicious_activity[ip].append((current_time, activity, path))
+    # Drop expired activities from the old end, then record the new one; under the
+    # lock so the janitor cannot drop this IP's deque between the lookup and append
+    with _suspicious_activity_lock:
+        activities = _suspicious_activity[ip]
+        _expire_activities(activities, current_time)
+        activities.append((current_time, activity, path))
+        # Everything left in the deque is within the window
+        recent_activities = list(activities)
     
     # Enhanced security logging with more details
     user_agent = request.headers.get('User-Agent', 'Unknown') if hasattr(request, 'headers') else 'Unknown'
@@ -265,7 +405,6 @@ def record_suspicious_activity(ip: str, activity: str, path: str):
     )
     
     # Check if threshold exceeded
-    recent_activities = [a for a in _suspicious_activity[ip] if current_time - a[0] < SUSPICIOUS_ACTIVITY_WINDOW]
     if len(recent_activities) >= MAX_SUSPICIOUS_ACTIVITIES:
         block_ip(ip, BLOCK_DURATION_HOURS)
         logger.error(
@@ -275,41 +414,86 @@ def record_suspicious_activity(ip: str, activity: str, path: str):
 
 def block_ip(ip: str, duration_hours: int = 24):
     """Block an IP address for specified duration"""
-    unblock_time = time.time() + (duration_hours * 3600)
-    _blocked_ips[ip] = unblock_time
-    logger.error(f"🚫 BLOCKED IP: {ip} for {duration_hours} hours (until {datetime.fromtimestamp(unblock_time)})")
+    _blocked_ips[ip] = time.monotonic() + (duration_hours * 3600)
+    unblock_at = datetime.now() + timedelta(hours=duration_hours)
+    logger.error(f"🚫 BLOCKED IP: {ip} for {duration_hours} hours (until {unblock_at})")
 
 def is_ip_blocked(ip: str) -> bool:
     """Check if an IP is currently blocked"""
-    if ip not in _blocked_ips:
+    # Single lookup; the common case is an IP that was never blocked
+    unblock_time = _blocked_ips.get(ip)
+    if unblock_time is None:
         return False
     
-    unblock_time = _blocked_ips[ip]
-    current_time = time.time()
-    
     # If block expired, remove it
-    if current_time >= unblock_time:
-        del _blocked_ips[ip]
+    if time.monotonic() >= unblock_time:
+        _blocked_ips.pop(ip, None)
         return False
     
     return True
 
 def clean_blocked_ips():
     """Clean expired IP blocks"""
-    current_time = time.time()
-    expired_ips = [ip for ip, unblock_time in _blocked_ips.items() if current_time >= unblock_time]
+    current_time = time.monotonic()
+    expired_ips = [ip for ip, unblock_time in list(_blocked_ips.items()) if current_time >= unblock_time]
     for ip in expired_ips:
-        del _blocked_ips[ip]
+        _blocked_ips.pop(ip, None)
         logger.info(f"✅ Unblocked IP: {ip} (block expired)")
 
+def _clean_suspicious():
+    """Drop IPs whose recorded suspicious activities have all left the window"""
+    current_time = time.monotonic()
+    stale_ips = [
+        ip for ip, activities in list(_suspicious_activity.items())
+        if not activities or current_time - activities[-1][0] >= SUSPICIOUS_ACTIVITY_WINDOW
+    ]
+    for ip in stale_ips:
+        with _suspicious_activity_lock:
+            # Re-check: a request may have recorded new activity since the snapshot
+            activities = _suspicious_activity.get(ip)
+            if activities is not None and (
+                not activities or current_time - activities[-1][0] >= SUSPICIOUS_ACTIVITY_WINDOW
+            ):
+                del _suspicious_activity[ip]
+
+def _janitor_loop():
+    """Expire security state in the background so request handlers never sweep it"""
+    while True:
+        time.sleep(JANITOR_INTERVAL)
+        try:
+            with _janitor_lock:
+                clean_rate_limit_storage()
+                clean_blocked_ips()
+                _clean_suspicious()
+        except Exception as e:
+            logger.error(f"Error cleaning security storage: {e}")
+
+def _start_janitor():
+    """Start the janitor thread once per process"""
+    global _janitor_thread
+    with _janitor_lock:
+        if _janitor_thread is None or not _janitor_thread.is_alive():
+            _janitor_thread = threading.Thread(target=_janitor_loop, name='security-janitor', daemon=True)
+            _janitor_thread.start()
+
 def get_suspicious_activity_count(ip: str, window_seconds: int = SUSPICIOUS_ACTIVITY_WINDOW) -> int:
     """Get count of suspicious activities for an IP in the last window_seconds"""
-    current_time = time.time()
-    if ip not in _suspicious_activity:
+    current_time = time.monotonic()
+    activities = _suspicious_activity.get(ip)
+    if not activities:
         return 0
     
-    recent = [a for a in _suspicious_activity[ip] if current_time - a[0] < window_seconds]
-    return len(recent)
+    _expire_activities(activities, current_time)
+    if window_seconds >= SUSPICIOUS_ACTIVITY_WINDOW:
+        return len(activities)
+    
+    # Narrower window: count back from the newest entry until one falls outside it
+    count = 0
+    for ts, _, _ in reversed(activities):
+        if current_time - ts >= window_seconds:
+            break
+        count += 1
+    return count
 
 def sanitize_error_message(error: Exception, include_details: bool = False) -> str:
     """Sanitize error messages to prevent information disclosure"""
@@ -329,36 +513,38 @@ def sanitize_error_message(error: Exception, include_details: bool = False) -> s
             return 'خطای سیستمی - لطفاً دوباره تلاش کنید'
     return str(error)
 
+# Response security headers; static, so built once - ALLOWING FONTS AND ICONS
+_SECURITY_HEADERS: Dict[str, str] = {
+    'X-Frame-Options': 'DENY',
+    'X-XSS-Protection': '1; mode=block',
+    'X-Content-Type-Options': 'nosniff',
+    'Referrer-Policy': 'strict-origin-when-cross-origin',
+    # IMPORTANT: Allow fonts and icons from CDNs
+    'Content-Security-Policy': (
+        "default-src 'self'; "
+        "script-src 'self' 'unsafe-inline' 'unsafe-eval' https://telegram.org https://cdn.telegram.org https://cdnjs.cloudflare.com; "
+        "style-src 'self' 'unsafe-inline' https://fonts.googleapis.com https://cdnjs.cloudflare.com https://cdn.jsdelivr.net; "
+        "font-src 'self' data: https://fonts.gstatic.com https://cdnjs.cloudflare.com https://cdn.jsdelivr.net; "
+        "img-src 'self' data: https:; "
+        "connect-src 'self' https://api.telegram.org; "
+        "frame-src 'self' https://telegram.org; "
+        "object-src 'none'; "
+        "base-uri 'self'; "
+        "form-action 'self'; "
+        "frame-ancestors 'none';"
+    ),
+    'Strict-Transport-Security': 'max-age=31536000; includeSubDomains; preload',
+    'Permissions-Policy': 'geolocation=(), microphone=(), camera=()',
+}
+
 def get_security_headers() -> Dict[str, str]:
     """Get comprehensive security headers - ALLOWING FONTS AND ICONS"""
-    return {
-        'X-Frame-Options': 'DENY',
-        'X-XSS-Protection': '1; mode=block',
-        'X-Content-Type-Options': 'nosniff',
-        'Referrer-Policy': 'strict-origin-when-cross-origin',
-        # IMPORTANT: Allow fonts and icons from CDNs
-        'Content-Security-Policy': (
-            "default-src 'self'; "
-            "script-src 'self' 'unsafe-inline' 'unsafe-eval' https://telegram.org https://cdn.telegram.org https://cdnjs.cloudflare.com; "
-            "style-src 'self' 'unsafe-inline' https://fonts.googleapis.com https://cdnjs.cloudflare.com https://cdn.jsdelivr.net; "
-            "font-src 'self' data: https://fonts.gstatic.com https://cdnjs.cloudflare.com https://cdn.jsdelivr.net; "
-            "img-src 'self' data: https:; "
-            "connect-src 'self' https://api.telegram.org; "
-            "frame-src 'self' https://telegram.org; "
-            "object-src 'none'; "
-            "base-uri 'self'; "
-            "form-action 'self'; "
-            "frame-ancestors 'none';"
-        ),
-        'Strict-Transport-Security': 'max-age=31536000; includeSubDomains; preload',
-        'Permissions-Policy': 'geolocation=(), microphone=(), camera=()',
-    }
+    # Copy so callers cannot alter what every response gets
+    return dict(_SECURITY_HEADERS)
 
 def apply_security_headers(response: Response) -> Response:
     """Apply security headers to response"""
-    headers = get_security_headers()
-    for key, value in headers.items():
-        response.headers[key] = value
+    response.headers.update(_SECURITY_HEADERS)
     # Remove server information
     response.headers.pop('Server', None)
     response.headers.pop('X-Powered-By', None)
@@ -366,72 +552,27 @@ def apply_security_headers(response: Response) -> Response:
 
 def detect_path_traversal(path: str) -> bool:
     """Detect path traversal attacks (../, ..\\, encoded versions)"""
-    path_lower = path.lower()
-    
-    # Check for common path traversal patterns
-    traversal_patterns = [
-        '../', '..\\', '%2e%2e%2f', '%2e%2e%5c',  # Basic traversal
-        '....//', '....\\\\',  # Double encoding attempts
-        '%252e%252e%252f',  # Double URL encoding
-        '..%2f', '..%5c',  # Mixed encoding
-        '/../', '\\..\\',  # With separators
-    ]
-    
-    # Check for excessive directory separators (potential traversal)
-    if path.count('../') > 3 or path.count('..\\') > 3:
-        return True
-    
-    # Check for encoded traversal
-    if any(pattern in path_lower for pattern in traversal_patterns):
-        return True
-    
-    # Check for absolute paths on Windows/Linux
-    if path.startswith('/etc/') or path.startswith('/proc/') or path.startswith('/sys/'):
-        return True
-    if re.match(r'^[a-z]:\\', path_lower):  # Windows drive letters
-        return True
-    
-    return False
+    return _TRAVERSAL_RE.search(path) is not None
 
 def detect_malformed_request() -> bool:
     """Detect malformed HTTP requests (binary data, invalid characters)"""
     try:
-        # Check request path for binary/null bytes
-        if request.path:
-            try:
-                request.path.encode('utf-8')
-            except UnicodeEncodeError:
-                return True
-            
-            # Check for null bytes
-            if '\x00' in request.path:
-                return True
+        # Werkzeug has already decoded path and headers to str; only null bytes remain to catch
+        if '\x00' in request.path:
+            return True
         
         # Check query string
-        if request.query_string:
-            try:
-                request.query_string.decode('utf-8')
-            except UnicodeDecodeError:
-                return True
-            
-            # Check for null bytes
-            if b'\x00' in request.query_string:
-                return True
+        if request.query_string and b'\x00' in request.query_string:
+            return True
         
-        # Check headers for suspicious content
-        for header_name, header_value in request.headers.items():
-            if header_value:
-                try:
-                    header_value.encode('utf-8')
-                except UnicodeEncodeError:
-                    return True
-                
-                # Check for null bytes
-                if '\x00' in header_value:
-                    return True
+        # Check the client-controlled headers for null bytes
+        for header_name in _UNTRUSTED_HEADERS:
+            header_value = request.headers.get(header_name)
+            if header_value and '\x00' in header_value:
+                return True
         
         # Check for suspicious HTTP methods
-        if request.method not in ['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS']:
+        if request.method not in _ALLOWED_METHODS:
             return True
         
     except Exception as e:
@@ -440,108 +581,45 @@ def detect_malformed_request() -> bool:
     
     return False
 
-def detect_attack_patterns(path: str) -> Tuple[bool, str]:
-    """Detect common attack patterns and return (is_attack, attack_type)"""
-    path_lower = path.lower()
+def get_request_path_lower() -> str:
+    """request.path.lower(), computed once per request and kept on g for later handlers"""
+    path_lower = g.get('path_lower')
+    if path_lower is None:
+        path_lower = g.path_lower = request.path.lower()
+    return path_lower
+
+def detect_attack_patterns(path: str, path_lower: Optional[str] = None) -> Tuple[bool, str]:
+    """
+    Detect common attack patterns and return (is_attack, attack_type)
+    
+    Args:
+        path: Request path
+        path_lower: path.lower(), if the caller already has it
+    """
+    if path_lower is None:
+        path_lower = path.lower()
     
     # Path traversal
     if detect_path_traversal(path):
         return True, 'path_traversal'
     
-    # PHP exploitation attempts (from logs: phpinfo, config.php, etc.)
-    php_attack_patterns = [
-        'phpunit', 'eval-stdin', 'phpinfo', 'php://', 'phar://',
-        'vendor/phpunit', 'composer.json', 'composer.lock',
-        'config.php', 'pinfo.php', 'test.php', 'info.php',
-        '?phpinfo', 'phpinfo=-1', 'phpinfo()'
-    ]
-    if any(pattern in path_lower for pattern in php_attack_patterns):
-        return True, 'php_exploitation'
-    
-    # WordPress scanning
-    wp_patterns = [
-        'wp-admin', 'wp-includes', 'wp-content', 'xmlrpc.php',
-        'wlwmanifest.xml', 'wp-config.php', 'wp-login.php'
-    ]
-    if any(pattern in path_lower for pattern in wp_patterns):
-        return True, 'wordpress_scanning'
+    if _ATTACK_AUTOMATON is not None:
+        # One pass over the path finds every pattern; the earliest category in
+        # _ATTACK_PATTERNS wins, as with the sequential checks below
+        first = min((priority for _, priority in _ATTACK_AUTOMATON.iter(path_lower)), default=None)
+        if first is None:
+            return False, ''
+        return True, _ATTACK_PATTERNS[first][0]
     
-    # Sensitive file access (from logs: .env, .git, robots.txt, etc.)
-    sensitive_patterns = [
-        '.env', '.git', '.svn', '.hg', '.bzr',  # Version control
-        '.sql', '.db', '.sqlite', '.sqlite3',  # Databases
-        'config.yaml', 'config.yml', 'docker-compose',  # Config files
-        'credentials', 'secrets', 'private',  # Sensitive names
-        '.backup', 'backup.sql', 'backup.zip', 'backup.tar', 'backup.tgz',  # Backup files
-        '.pem', '.key', '.crt', '.p12', '.pfx',  # Certificates
-        'phpinfo', 'info.php', 'test.php',  # Info disclosure
-        'admin.php', 'login.php', 'config.php',  # Admin files
-        'robots.txt',  # Common scanning target
-        'client_secrets.json',  # OAuth secrets
-        'appsettings.json',  # .NET config
-    ]
-    if any(pattern in path_lower for pattern in sensitive_patterns):
-        return True, 'sensitive_file_access'
-    
-    # CGI/Shell access attempts (from logs: /cgi-bin/luci/)
-    cgi_patterns = [
-        '/cgi-bin/', '/bin/sh', '/bin/bash', '/usr/bin/env',
-        'cmd.exe', 'powershell.exe', 'wmic.exe',
-        'cgi-bin/luci', 'cgi-bin/', '/locale'
-    ]
-    if any(pattern in path_lower for pattern in cgi_patterns):
-        return True, 'shell_access_attempt'
-    
-    # Cisco router exploits
-    if '/+csco' in path_lower or '/+csce' in path_lower:
-        return True, 'cisco_exploit'
-    
-    # Laravel/Symfony exploits (from logs: app_dev.php, _profiler/)
-    laravel_patterns = [
-        '/.env', '/app_dev.php', '/_profiler/', '/debug/',
-        '/api/.env', '/laravel/.env', '/backend/.env',
-        '/misc/.env', '/content/.env', '/docker/.env',
-        '/env/.env', '/Dev/.env', '/cron/.env',
-        '/localhost/.env', '/.gitlab-ci/.env',
-        '/laravel/.env.production', '/local/.env.prod',
-        '/public/.env', '/frontend/.env', '/locally/.env',
-        '/v2/.env', '/lab/.env', '/.vscode/.env',
-        '/.env.backup', '/.env.example'
-    ]
-    if any(pattern in path_lower for pattern in laravel_patterns):
-        return True, 'framework_exploit'
-    
-    # Java exploitation (from logs: actuator/gateway/routes)
-    java_patterns = [
-        'actuator', '/gateway/routes', '.jar',
-        'spring-boot-actuator', '/actuator/'
-    ]
-    if any(pattern in path_lower for pattern in java_patterns):
-        return True, 'java_exploit'
-    
-    # XDEBUG exploitation attempts (from logs: ?XDEBUG_SESSION_START=phpstorm)
-    if 'xdebug' in path_lower or 'xdebug_session' in path_lower:
-        return True, 'xdebug_exploit'
-    
-    # Development server scanning (from logs: developmentserver/metadatauploader)
-    dev_patterns = [
-        'developmentserver', 'metadatauploader', 'dev.php',
-        'development', 'staging', 'test.php'
-    ]
-    if any(pattern in path_lower for pattern in dev_patterns):
-        return True, 'dev_server_scanning'
-    
-    # HTTP/2.0 protocol attacks (from logs: PRI * HTTP/2.0)
-    if 'http/2.0' in path_lower or 'pri *' in path_lower:
-        return True, 'http2_protocol_attack'
+    for attack_type, patterns in _ATTACK_PATTERNS:
+        if any(pattern in path_lower for pattern in patterns):
+            return True, attack_type
     
     return False, ''
 
 def secure_before_request():
     """Comprehensive security check before every request"""
-    # Clean expired blocks periodically
-    if time.time() % 60 < 1:  # Every minute
-        clean_blocked_ips()
+    current_time = time.monotonic()
     
     # Get client IP
     client_ip = get_client_ip()
@@ -557,8 +635,7 @@ def secure_before_request():
     if is_whitelisted or has_valid_session:
         if is_ip_blocked(client_ip):
             logger.info(f"🔓 Unblocking IP {client_ip} because of valid session or whitelist")
-            if client_ip in _blocked_ips:
-                del _blocked_ips[client_ip]
+            _blocked_ips.pop(client_ip, None)
         # Skip further checks for whitelisted/admin users to prevent accidental blocking
         return None
     
@@ -573,20 +650,14 @@ def secure_before_request():
         return Response('Bad Request', status=400, mimetype='text/plain')
     
     # Check for attack patterns
-    path_lower = request.path.lower()
+    path_lower = get_request_path_lower()
     
     # Allow legitimate static files
-    allowed_static_extensions = ['.css', '.js', '.jpg', '.jpeg', '.png', '.gif', '.svg', 
-                                 '.woff', '.woff2', '.ttf', '.eot', '.ico', '.webp']
-    is_static_file = (path_lower.endswith(tuple(allowed_static_extensions)) or 
-                     '/static/' in path_lower or 
-                     '/css/' in path_lower or 
-                     '/js/' in path_lower or 
-                     '/images/' in path_lower)
+    is_static_file = path_lower.endswith(_STATIC_EXTENSIONS) or _STATIC_DIR_RE.search(path_lower) is not None
     
     # Only check for attacks if not a legitimate static file
     if not is_static_file:
-        is_attack, attack_type = detect_attack_patterns(request.path)
+        is_attack, attack_type = detect_attack_patterns(request.path, path_lower)
         if is_attack:
             record_suspicious_activity(client_ip, attack_type, request.path)
             return Response('Not Found', status=404, mimetype='text/plain')
@@ -596,18 +667,13 @@ def secure_before_request():
     if suspicious_count > 0:
         # Apply stricter rate limiting for suspicious IPs
         route_key = f"{client_ip}:{request.endpoint}"
-        current_time = time.time()
         
-        if route_key in _rate_limit_storage:
-            timestamps = _rate_limit_storage[route_key]
-            timestamps[:] = [ts for ts in timestamps if current_time - ts < 60]
-            
-            # Limit to 2 requests per minute for suspicious IPs
-            if len(timestamps) >= 2:
+        # Only on rate-limited routes this IP has already used
+        if route_key in _rate_limit_buckets:
+            if _take_token(_suspicious_rate_limit_buckets, route_key, SUSPICIOUS_MAX_REQUESTS,
+                           SUSPICIOUS_RATE_WINDOW, current_time):
                 logger.warning(f"Rate limit exceeded for suspicious IP {client_ip} on {request.endpoint}")
                 return Response('Too Many Requests', status=429, mimetype='text/plain')
-            
-            timestamps.append(current_time)
     
     return None  # Continue with request
 
@@ -618,3 +684,5 @@ def secure_after_request(response: Response) -> Response:
 # Import os for urandom
 import os
 
+_start_janitor()
+
@@ -148,6 +148,13 @@ class VPNBot:
             MessageTemplates.set_database_name(self.db.database_name)
             logger.info(f"✅ TextManager initialized successfully for database: {self.db.database_name}")
             
+            # Warm the text cache so message rendering does not query bot_texts per key
+            try:
+                loaded = MessageTemplates.prime_text_cache(self.db.database_name)
+                logger.info(f"✅ Loaded {loaded} customized texts into cache")
+            except Exception as prime_e:
+                logger.warning(f"⚠️ Could not prime text cache: {prime_e}")
+            
             # Test: Try to get a text from database to verify it works
             try:
                 test_text = self.text_manager.get_text('welcome.main', use_default_if_missing=True)
@@ -238,7 +238,7 @@ class TextManager:
         # Substitute variables if provided
         if variables:
             try:
-                text_content = text_content.format(**variables)
+                text_content = text_content.format_map(variables)
             except KeyError as e:
                 logger.warning(f"Missing variable {e} in text {text_key}")
                 # Try to continue with available variables
@@ -246,7 +246,7 @@ class TextManager:
                     # Only use variables that exist in the text
                     available_vars = {k: v for k, v in variables.items() 
                                      if f'{{{k}}}' in text_content}
-                    text_content = text_content.format(**available_vars)
+                    text_content = text_content.format_map(available_vars)
                 except Exception as e2:
                     logger.error(f"Error formatting text {text_key}: {e2}")
             except Exception as e:
@@ -349,13 +349,13 @@ class TextManager:
         Handles missing variables gracefully
         """
         try:
-            return text.format(**variables)
+            return text.format_map(variables)
         except KeyError as e:
             # Try with only available variables
             available_vars = {k: v for k, v in variables.items() 
                             if f'{{{k}}}' in text}
             try:
-                return text.format(**available_vars)
+                return text.format_map(available_vars)
             except Exception:
                 logger.error(f"Error formatting text with variables: {e}")
                 return text
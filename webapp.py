@@ -26,7 +26,7 @@ from security_utils import (
     validate_telegram_id, validate_amount, validate_positive_int, 
     validate_panel_id, validate_discount_code, secure_before_request, 
     secure_after_request, get_client_ip, block_ip, is_ip_blocked,
-    record_suspicious_activity, sanitize_error_message
+    record_suspicious_activity, sanitize_error_message, get_request_path_lower
 )
 
 import httpx
@@ -68,7 +68,11 @@ def secure_error_response(error: Exception, default_message: str = 'خطای س
         safe_message = default_message
     
     return jsonify({'success': False, 'message': safe_message}), 500
-from cache_utils import cache, cache_key_user, cache_key_user_services, cache_key_stats, invalidate_user_cache
+from cache_utils import (
+    cache, cache_key_user, cache_key_user_services, cache_key_stats, invalidate_user_cache,
+    cache_key_products_panel, cache_tag_panel, invalidate_panel_cache,
+    invalidate_discount_code_cache, invalidate_gift_code_cache
+)
 
 # Configure logging with UTF-8 encoding to handle emoji and Persian characters
 import sys
@@ -287,7 +291,8 @@ def security_check():
         for header, value in request.headers.items():
             logger.info(f"  {header}: {value}")
             
-    path_lower = request.path.lower()
+    # Shared with secure_before_request and the 404 handler via flask.g
+    path_lower = get_request_path_lower()
     
     # Allow all legitimate static files (CSS, JS, images, fonts, icons)
     allowed_static_extensions = ['.css', '.js', '.jpg', '.jpeg', '.png', '.gif', '.svg', '.woff', '.woff2', '.ttf', '.eot', '.ico', '.webp']
@@ -2394,12 +2399,24 @@ def api_get_panel_products(panel_id):
         
         db_instance = get_db()
         
-        if category_id:
-            # Get products for specific category
-            products = db_instance.get_products(panel_id, category_id=category_id, active_only=True)
-        else:
-            # Get products without category (when category_id is None or not provided)
-            products = db_instance.get_products(panel_id, category_id=False, active_only=True)
+        # Products per panel/category are cached under the panel tag, so
+        # invalidate_panel_cache drops every category at once. The bot edits panels
+        # and products from another process without clearing this cache, so the TTL
+        # is kept to a few seconds: it only absorbs bursts of identical requests, and
+        # orders are priced from get_product(), never from this list
+        products_cache_key = cache_key_products_panel(panel_id, category_id or 0)
+        products = cache.get(products_cache_key)
+        if products is None:
+            if category_id:
+                # Get products for specific category
+                products = db_instance.get_products(panel_id, category_id=category_id, active_only=True)
+            else:
+                # Get products without category (when category_id is None or not provided)
+                products = db_instance.get_products(panel_id, category_id=False, active_only=True)
+            cache.set_with_tag(products_cache_key, products, cache_tag_panel(panel_id), ttl=5)
+        
+        # Copies: reseller prices below must not leak into the cached entry
+        products = [dict(product) for product in products]
         
         # Calculate discounts for resellers
         telegram_id = session.get('telegram_id')
@@ -2976,9 +2993,9 @@ def api_create_service():
                     
                     # Invalidate caches after service creation
                     invalidate_user_cache(user_id)
-                    from cache_utils import cache_key_panels_active, cache_key_products_panel
+                    from cache_utils import cache_key_panels_active
                     cache.delete(cache_key_panels_active())
-                    cache.delete(cache_key_products_panel(panel_id))
+                    invalidate_panel_cache(panel_id)
                     
                     # Report service purchase to channel
                     try:
@@ -3152,9 +3169,9 @@ def api_create_service():
             
             # Invalidate caches
             invalidate_user_cache(user_id)
-            from cache_utils import cache_key_panels_active, cache_key_products_panel
+            from cache_utils import cache_key_panels_active
             cache.delete(cache_key_panels_active())
-            cache.delete(cache_key_products_panel(panel_id))
+            invalidate_panel_cache(panel_id)
             
             # Create payment link
             payment_result = payment_manager.create_service_payment(
@@ -6548,6 +6565,9 @@ def api_admin_update_panel(panel_id):
         )
         
         if success:
+            from cache_utils import cache_key_panels_active
+            cache.delete(cache_key_panels_active())
+            invalidate_panel_cache(panel_id)
             logger.info(f"Panel {panel_id} updated successfully")
             return jsonify({'success': True, 'message': message}), 200
         else:
@@ -6569,6 +6589,9 @@ def api_admin_delete_panel(panel_id):
         success, message = admin_mgr.delete_panel(panel_id)
         
         if success:
+            from cache_utils import cache_key_panels_active
+            cache.delete(cache_key_panels_active())
+            invalidate_panel_cache(panel_id)
             return jsonify({'success': True, 'message': message})
         else:
             return jsonify({'success': False, 'message': message}), 400
@@ -7457,6 +7480,7 @@ def api_admin_update_discount(code_id):
                     query = f"UPDATE discount_codes SET {', '.join(updates)} WHERE id = %s"
                     cursor.execute(query, params)
                     conn.commit()
+                    invalidate_discount_code_cache(db.database_name, code_id)
             finally:
                 cursor.close()
                 
@@ -7504,6 +7528,7 @@ def api_admin_update_gift_code(code_id):
                     query = f"UPDATE gift_codes SET {', '.join(updates)} WHERE id = %s"
                     cursor.execute(query, params)
                     conn.commit()
+                    invalidate_gift_code_cache(db.database_name, code_id)
             finally:
                 cursor.close()
                 
@@ -7573,6 +7598,7 @@ def api_admin_add_category(panel_id):
         category_id = db.add_category(panel_id, data.get('name', ''))
         
         if category_id:
+            invalidate_panel_cache(panel_id)
             return jsonify({'success': True, 'message': 'دسته‌بندی با موفقیت اضافه شد', 'category_id': category_id})
         else:
             return jsonify({'success': False, 'message': 'خطا در افزودن دسته‌بندی'}), 400
@@ -7593,6 +7619,7 @@ def api_admin_update_category(panel_id, category_id):
         )
         
         if success:
+            invalidate_panel_cache(panel_id)
             return jsonify({'success': True, 'message': 'دسته‌بندی با موفقیت بروزرسانی شد'})
         else:
             return jsonify({'success': False, 'message': 'خطا در بروزرسانی دسته‌بندی'}), 400
@@ -7608,6 +7635,7 @@ def api_admin_delete_category(panel_id, category_id):
         success = db.delete_category(category_id)
         
         if success:
+            invalidate_panel_cache(panel_id)
             return jsonify({'success': True, 'message': 'دسته‌بندی با موفقیت حذف شد'})
         else:
             return jsonify({'success': False, 'message': 'خطا در حذف دسته‌بندی'}), 400
@@ -7648,6 +7676,7 @@ def api_admin_add_product(panel_id):
         )
         
         if product_id:
+            invalidate_panel_cache(panel_id)
             return jsonify({'success': True, 'message': 'محصول با موفقیت اضافه شد', 'product_id': product_id})
         else:
             return jsonify({'success': False, 'message': 'خطا در افزودن محصول'}), 400
@@ -7675,6 +7704,7 @@ def api_admin_update_product(product_id):
     """Update a product"""
     try:
         data = request.json
+        product = db.get_product(product_id)
         success = db.update_product(
             product_id,
             name=data.get('name'),
@@ -7685,6 +7715,8 @@ def api_admin_update_product(product_id):
         )
         
         if success:
+            if product:
+                invalidate_panel_cache(product['panel_id'])
             return jsonify({'success': True, 'message': 'محصول با موفقیت بروزرسانی شد'})
         else:
             return jsonify({'success': False, 'message': 'خطا در بروزرسانی محصول'}), 400
@@ -7714,9 +7746,12 @@ def api_admin_delete_product(product_id):
                     'message': f'نمی‌توان این محصول را حذف کرد. {result["count"]} سرویس فعال از این محصول استفاده می‌کنند.'
                 }), 400
         
+        product = db.get_product(product_id)
         success = db.delete_product(product_id)
         
         if success:
+            if product:
+                invalidate_panel_cache(product['panel_id'])
             return jsonify({'success': True, 'message': 'محصول با موفقیت حذف شد'})
         else:
             return jsonify({'success': False, 'message': 'خطا در حذف محصول'}), 400
@@ -7820,6 +7855,8 @@ def api_admin_copy_products(source_panel_id, target_panel_id):
                     )
                 copied_products += 1
         
+        invalidate_panel_cache(target_panel_id)
+        
         message = f'{copied_categories} دسته‌بندی و {copied_products} محصول کپی شد'
         if skipped_products > 0:
             message += f' ({skipped_products} محصول به دلیل تکراری بودن نادیده گرفته شد)'
@@ -8609,7 +8646,7 @@ def not_found(e):
     
     # Use comprehensive attack detection
     from security_utils import detect_attack_patterns, record_suspicious_activity
-    is_attack, attack_type = detect_attack_patterns(request.path)
+    is_attack, attack_type = detect_attack_patterns(request.path, get_request_path_lower())
     if is_attack:
         record_suspicious_activity(client_ip, f'404_{attack_type}', request.path)
     